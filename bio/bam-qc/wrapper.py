@@ -0,0 +1,223 @@
+"""Snakemake wrapper computing several alignment QC metrics in a single pass."""
+
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2026, Johannes Köster"
+__email__ = "johannes.koester@protonmail.com"
+__license__ = "MIT"
+
+import os
+import re
+import select
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from snakemake.shell import shell
+from snakemake_wrapper_utils.java import get_java_opts
+
+exts_to_prog = {
+    ".alignment_summary_metrics": "CollectAlignmentSummaryMetrics",
+    ".insert_size_metrics": "CollectInsertSizeMetrics",
+    ".insert_size_histogram.pdf": "CollectInsertSizeMetrics",
+    ".quality_distribution_metrics": "QualityScoreDistribution",
+    ".quality_distribution.pdf": "QualityScoreDistribution",
+    ".quality_by_cycle_metrics": "MeanQualityByCycle",
+    ".quality_by_cycle.pdf": "MeanQualityByCycle",
+    ".base_distribution_by_cycle_metrics": "CollectBaseDistributionByCycle",
+    ".base_distribution_by_cycle.pdf": "CollectBaseDistributionByCycle",
+    ".gc_bias.detail_metrics": "CollectGcBiasMetrics",
+    ".gc_bias.summary_metrics": "CollectGcBiasMetrics",
+    ".gc_bias.pdf": "CollectGcBiasMetrics",
+    ".rna_metrics": "RnaSeqMetrics",
+    ".bait_bias_detail_metrics": "CollectSequencingArtifactMetrics",
+    ".bait_bias_summary_metrics": "CollectSequencingArtifactMetrics",
+    ".error_summary_metrics": "CollectSequencingArtifactMetrics",
+    ".pre_adapter_detail_metrics": "CollectSequencingArtifactMetrics",
+    ".pre_adapter_summary_metrics": "CollectSequencingArtifactMetrics",
+    ".quality_yield_metrics": "CollectQualityYieldMetrics",
+}
+
+
+bam = snakemake.input.bam
+ref = snakemake.input.get("ref", "")
+params = snakemake.params
+output = snakemake.output
+
+# Producers reading the decoded record stream ({stream} is replaced by a FIFO)
+streamed = {}
+# Producers needing the index or random access to the alignment file
+direct = {}
+
+if output.get("stats"):
+    streamed["stats"] = "samtools stats {} {} {{stream}} > {}".format(
+        params.get("stats", ""), f"--reference {ref}" if ref else "", output.stats
+    )
+
+if output.get("flagstat"):
+    streamed["flagstat"] = "samtools flagstat {} {{stream}} > {}".format(
+        params.get("flagstat", ""), output.flagstat
+    )
+
+if output.get("multiple_metrics"):
+    # Select programs to run from output files
+    progs = set()
+    for file in output.multiple_metrics:
+        for ext in exts_to_prog:
+            if file.endswith(ext):
+                progs.add(exts_to_prog[ext])
+                prefix = file[: -len(ext)]
+                break
+        else:
+            raise ValueError(
+                "Unknown type of metrics file requested, for possible metrics files, see https://snakemake-wrappers.readthedocs.io/en/stable/wrappers/picard/collectmultiplemetrics.html"
+            )
+    streamed["multiple_metrics"] = (
+        "picard CollectMultipleMetrics {{java_opts}} {}"
+        " --INPUT {{stream}} --TMP_DIR {{tmpdir}} --OUTPUT {}"
+        " {} --PROGRAM null --PROGRAM {}".format(
+            params.get("multiple_metrics", ""),
+            prefix,
+            f"--REFERENCE_SEQUENCE {ref}" if ref else "",
+            " --PROGRAM ".join(sorted(progs)),
+        )
+    )
+
+if output.get("hs_metrics"):
+    streamed["hs_metrics"] = (
+        "picard CollectHsMetrics {{java_opts}} {}"
+        " --INPUT {{stream}} --TMP_DIR {{tmpdir}} --OUTPUT {}"
+        " {} --BAIT_INTERVALS {} --TARGET_INTERVALS {}".format(
+            params.get("hs_metrics", ""),
+            output.hs_metrics,
+            f"--REFERENCE_SEQUENCE {ref}" if ref else "",
+            snakemake.input.bait_intervals,
+            snakemake.input.target_intervals,
+        )
+    )
+
+if output.get("idxstats"):
+    # Only reads the index, not the records
+    direct["idxstats"] = "samtools idxstats {} {} > {}".format(
+        params.get("idxstats", ""), bam, output.idxstats
+    )
+
+if output.get("mosdepth"):
+    if not output.mosdepth.endswith(".mosdepth.summary.txt"):
+        raise ValueError("mosdepth output must end with '.mosdepth.summary.txt'")
+    direct["mosdepth"] = "mosdepth {} {} {} {}".format(
+        params.get("mosdepth", ""),
+        f"--fasta {ref}" if ref else "",
+        output.mosdepth[: -len(".mosdepth.summary.txt")],
+        bam,
+    )
+
+if output.get("qualimap"):
+    # unset DISPLAY environment variable to avoid X11 error message issued by qualimap
+    if os.environ.get("DISPLAY"):
+        del os.environ["DISPLAY"]
+    direct["qualimap"] = (
+        'JAVA_OPTS="{{java_opts}}" qualimap bamqc {} -bam {} -outdir {}'.format(
+            params.get("qualimap", ""), bam, output.qualimap
+        )
+    )
+
+if not streamed and not direct:
+    raise ValueError("no QC output requested")
+
+
+# The JVMs running side by side share the memory of the job
+java_opts = get_java_opts(snakemake)
+jvms = sum(
+    tool in streamed or tool in direct
+    for tool in ("multiple_metrics", "hs_metrics", "qualimap")
+)
+if jvms > 1:
+    java_opts = re.sub(
+        r"-Xmx(\d+)M",
+        lambda xmx: "-Xmx{}M".format(int(xmx.group(1)) // jvms),
+        java_opts,
+    )
+
+# The decoder gets the threads not taken by the metric producers
+decoder_threads = max(1, snakemake.threads - len(streamed) - len(direct))
+
+
+def drain(fifo, done):
+    """Read and discard a stream until its writer is done"""
+    # Opened read-write, the FIFO never blocks tee, whether it opens its end
+    # before or after this one, and is read until the decoder has finished
+    fd = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
+    try:
+        while True:
+            finished = done.is_set()
+            if select.select([fd], [], [], 1)[0]:
+                os.read(fd, 1 << 16)
+            elif finished:
+                break
+    finally:
+        os.close(fd)
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    decoded = threading.Event()
+    fifos = {tool: os.path.join(tmpdir, f"{tool}.bam") for tool in streamed}
+    for fifo in fifos.values():
+        os.mkfifo(fifo)
+    logs = {
+        tool: os.path.join(tmpdir, f"{tool}.log")
+        for tool in ["decoder"] * bool(streamed) + list(streamed) + list(direct)
+    }
+
+    def produce(tool, cmd):
+        tool_tmpdir = os.path.join(tmpdir, f"{tool}.tmp")
+        os.mkdir(tool_tmpdir)
+        cmd = cmd.format(
+            stream=fifos.get(tool), tmpdir=tool_tmpdir, java_opts=java_opts
+        )
+        tool_log = logs[tool]
+        try:
+            shell("{cmd} 2> {tool_log}")
+        finally:
+            # Keep consuming the stream of a producer that stopped early, so
+            # that tee goes on feeding the others
+            if tool in fifos:
+                drain(fifos[tool], decoded)
+
+    def decode():
+        # Decompress the alignments once and hand the uncompressed BAM
+        # stream over to every streamed producer
+        *teed, last = fifos.values()
+        ref_opt = f"--reference {ref}" if ref else ""
+        decoder_log = logs["decoder"]
+        try:
+            shell(
+                "samtools view -u -@ {decoder_threads} {ref_opt} {bam}"
+                " 2> {decoder_log}"
+                " | tee --output-error=warn-nopipe {teed} > {last}"
+            )
+        finally:
+            decoded.set()
+
+    try:
+        with ThreadPoolExecutor(len(logs)) as executor:
+            jobs = [
+                executor.submit(produce, tool, cmd)
+                for tool, cmd in {**streamed, **direct}.items()
+            ]
+            if streamed:
+                jobs.append(executor.submit(decode))
+            for job in jobs:
+                job.result()
+    finally:
+        if snakemake.log:
+            all_logs = list(logs.values())
+            shell("cat {all_logs} > {snakemake.log}")
+
+
+# Under some circumstances, some picard programs might not produce an output (https://github.com/snakemake/snakemake-wrappers/issues/357). To avoid snakemake errors, the output files of those programs are created empty (if they do not exist).
+for ext in [
+    ext for ext, prog in exts_to_prog.items() if prog in ["CollectInsertSizeMetrics"]
+]:
+    for file in output.get("multiple_metrics", []):
+        if file.endswith(ext) and not os.path.exists(file):
+            open(file, "w").close()
@@ -3,7 +3,9 @@ __copyright__ = "Copyright 2020, Tetsuro Hisayoshi"
 __email__ = "hisayoshi0530@gmail.com"
 __license__ = "MIT"
 
+import hashlib
 import os
+import shutil
 import tempfile
 from snakemake.shell import shell
 
@@ -18,34 +20,88 @@ sample_name = snakemake.params.get(
     "sample_name", os.path.splitext(os.path.basename(snakemake.input.bam))[0]
 )
 
+# Persistent directory keeping the examples and inference results,
+# so that finished stages are not recomputed on retry
+work_dir = snakemake.params.get("work_dir", "")
+
 
 make_examples_gvcf = postprocess_gvcf = ""
 gvcf = snakemake.output.get("gvcf", None)
 if gvcf:
     make_examples_gvcf = "--gvcf {tmp_dir} "
     postprocess_gvcf = (
-        "--gvcf_infile {tmp_dir}/{sample_name}.gvcf.tfrecord@{snakemake.threads}.gz "
+        "--gvcf_infile {tmp_dir}/{sample_name}.gvcf.tfrecord@{shards}.gz "
         "--gvcf_outfile {snakemake.output.gvcf} "
     )
 
-with tempfile.TemporaryDirectory() as tmp_dir:
-    shell(
-        "(dv_make_examples.py "
-        "--cores {snakemake.threads} "
-        "--ref {snakemake.input.ref} "
-        "--reads {snakemake.input.bam} "
-        "--sample {sample_name} "
-        "--examples {tmp_dir} "
-        "--logdir {log_dir} " + make_examples_gvcf + "{extra} \n"
-        "dv_call_variants.py "
-        "--cores {snakemake.threads} "
-        "--outfile {tmp_dir}/{sample_name}.tmp "
-        "--sample {sample_name} "
-        "--examples {tmp_dir} "
-        "--model {snakemake.params.model} \n"
-        "dv_postprocess_variants.py "
-        "--ref {snakemake.input.ref} "
-        + postprocess_gvcf
-        + "--infile {tmp_dir}/{sample_name}.tmp "
-        "--outfile {snakemake.output.vcf} ) {log}"
-    )
+make_examples = (
+    "dv_make_examples.py "
+    "--cores {shards} "
+    "--ref {snakemake.input.ref} "
+    "--reads {snakemake.input.bam} "
+    "--sample {sample_name} "
+    "--examples {tmp_dir} "
+    "--logdir {log_dir} " + make_examples_gvcf + "{extra} "
+)
+call_variants = (
+    "dv_call_variants.py "
+    "--cores {shards} "
+    "--outfile {tmp_dir}/{sample_name}.tmp "
+    "--sample {sample_name} "
+    "--examples {tmp_dir} "
+    "--model {snakemake.params.model} "
+)
+postprocess_variants = (
+    "dv_postprocess_variants.py "
+    "--ref {snakemake.input.ref} "
+    + postprocess_gvcf
+    + "--infile {tmp_dir}/{sample_name}.tmp "
+    "--outfile {snakemake.output.vcf} "
+)
+
+if not work_dir:
+    shards = snakemake.threads
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        shell(
+            "("
+            + make_examples
+            + "\n"
+            + call_variants
+            + "\n"
+            + postprocess_variants
+            + ") {log}"
+        )
+else:
+    # Intermediate results are only reused by a run on the same inputs
+    # (paths, sizes and modification times) and parameters
+    key = hashlib.sha256()
+    for path in snakemake.input:
+        stat = os.stat(path)
+        key.update(
+            f"{os.path.abspath(path)}\t{stat.st_size}\t{stat.st_mtime}\n".encode()
+        )
+    key.update(f"{sample_name}\t{snakemake.params.model}\t{extra}\t{gvcf}".encode())
+    tmp_dir = os.path.join(work_dir, f"{sample_name}.{key.hexdigest()[:16]}")
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    # Examples are sharded by the number of threads of the run which made
+    # them; later stages of a retried run stick to that number of shards
+    make_examples_done = os.path.join(tmp_dir, "make_examples.done")
+    call_variants_done = os.path.join(tmp_dir, "call_variants.done")
+    if os.path.exists(make_examples_done):
+        with open(make_examples_done) as done:
+            shards = int(done.read())
+    else:
+        shards = snakemake.threads
+        shell("(" + make_examples + ") {log}")
+        with open(make_examples_done, "w") as done:
+            done.write(str(shards))
+        log = snakemake.log_fmt_shell(stdout=True, stderr=True, append=True)
+
+    if not os.path.exists(call_variants_done):
+        shell("(" + call_variants + ") {log}")
+        open(call_variants_done, "w").close()
+        log = snakemake.log_fmt_shell(stdout=True, stderr=True, append=True)
+
+    shell("(" + postprocess_variants + ") {log}")
+    shutil.rmtree(tmp_dir)
@@ -4,13 +4,17 @@ __email__ = "koester@jimmy.harvard.edu"
 __license__ = "MIT"
 
 
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 from snakemake.shell import shell
 from snakemake_wrapper_utils.bcftools import get_bcftools_opts
 
-
 bcftools_opts = get_bcftools_opts(snakemake, parse_ref=False, parse_memory=False)
 extra = snakemake.params.get("extra", "")
 log = snakemake.log_fmt_shell(stdout=True, stderr=True)
+svtypes = snakemake.params.get("svtypes", [])
 
 
 exclude = snakemake.input.get("exclude", "")
@@ -18,14 +22,56 @@ if exclude:
     exclude = f"-x {exclude}"
 
 
-shell(
-    "(OMP_NUM_THREADS={snakemake.threads} delly call"
-    " -g {snakemake.input.ref}"
-    " {exclude}"
-    " {extra}"
-    " {snakemake.input.alns} | "
-    # Convert output to specified format
-    "bcftools view"
-    " {bcftools_opts}"
-    ") {log}"
-)
+if not svtypes:
+    shell(
+        "(OMP_NUM_THREADS={snakemake.threads} delly call"
+        " -g {snakemake.input.ref}"
+        " {exclude}"
+        " {extra}"
+        " {snakemake.input.alns} | "
+        # Convert output to specified format
+        "bcftools view"
+        " {bcftools_opts}"
+        ") {log}"
+    )
+else:
+    # Delly only parallelises across samples, so SV types are called by
+    # concurrent delly processes sharing the thread reservation
+    jobs = min(len(svtypes), snakemake.threads)
+    omp_threads = max(1, snakemake.threads // jobs)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        calls = [os.path.join(tmpdir, f"{svtype}.bcf") for svtype in svtypes]
+        logs = [os.path.join(tmpdir, f"{svtype}.log") for svtype in svtypes]
+
+        def call(svtype, svtype_calls, svtype_log):
+            shell(
+                "OMP_NUM_THREADS={omp_threads} delly call"
+                " -t {svtype}"
+                " -g {snakemake.input.ref}"
+                " {exclude}"
+                " {extra}"
+                " -o {svtype_calls}"
+                " {snakemake.input.alns}"
+                " > {svtype_log} 2>&1"
+            )
+
+        try:
+            with ThreadPoolExecutor(jobs) as executor:
+                for job in [
+                    executor.submit(call, *args) for args in zip(svtypes, calls, logs)
+                ]:
+                    job.result()
+        finally:
+            if snakemake.log:
+                shell("cat {logs} > {snakemake.log}")
+
+        log = snakemake.log_fmt_shell(stdout=True, stderr=True, append=True)
+        shell(
+            "(bcftools concat --output-type u {calls} | "
+            "bcftools sort --temp-dir {tmpdir} --output-type u | "
+            # Convert output to specified format
+            "bcftools view"
+            " {bcftools_opts}"
+            ") {log}"
+        )
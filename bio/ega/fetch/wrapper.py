@@ -1,9 +1,9 @@
 from pathlib import Path
+import os
 import shlex
 import shutil
 import subprocess as sp
 import sys
-import tempfile
 
 if snakemake.log:
     sys.stderr = open(snakemake.log[0], "w")
@@ -15,25 +15,37 @@ fmt = Path(snakemake.output[0]).suffix[1:].upper()
 extra_pyega3 = shlex.split(snakemake.params.get("extra_pyega3", ""))
 extra_fetch = shlex.split(snakemake.params.get("extra_fetch", ""))
 
-with tempfile.TemporaryDirectory() as tmpdir:
-    cmd = (
-        ["pyega3"]
-        + extra_pyega3
-        + ["fetch", "--output-dir", tmpdir, "--format", fmt, fileid]
-        + extra_fetch
-    )
-    sp.run(
-        cmd,
-        stdout=sys.stderr,
-        stderr=sp.STDOUT,
-        check=True,
-    )
-    # obtain path to the downloaded file (it should be the only file with that
-    # extension in the temp dir)
-    glob_res = list((Path(tmpdir) / fileid).glob(f"*.{fmt.lower()}"))
-    assert (
-        len(glob_res) == 1
-    ), "bug: more than one file with desired extension downloaded by pyega3"
-
-    # Move the file to the output
-    shutil.move(glob_res[0], snakemake.output[0])
+# One download connection per thread
+if not {"-c", "--connections"} & set(extra_pyega3):
+    extra_pyega3 += ["--connections", str(snakemake.threads)]
+slice_size = snakemake.params.get("slice_size", "")
+if slice_size:
+    extra_pyega3 += ["--max-slice-size", str(slice_size)]
+
+# Downloaded slices are kept next to the output until the file is complete,
+# so that a restarted job resumes the download and the final move is a rename
+download_dir = Path(snakemake.output[0] + ".download")
+download_dir.mkdir(parents=True, exist_ok=True)
+
+cmd = (
+    ["pyega3"]
+    + extra_pyega3
+    + ["fetch", "--output-dir", str(download_dir), "--format", fmt, fileid]
+    + extra_fetch
+)
+sp.run(
+    cmd,
+    stdout=sys.stderr,
+    stderr=sp.STDOUT,
+    check=True,
+)
+# obtain path to the downloaded file (it should be the only file with that
+# extension in the download dir)
+glob_res = list((download_dir / fileid).glob(f"*.{fmt.lower()}"))
+assert (
+    len(glob_res) == 1
+), "bug: more than one file with desired extension downloaded by pyega3"
+
+# Move the file to the output
+os.replace(glob_res[0], snakemake.output[0])
+shutil.rmtree(download_dir)
@@ -1,9 +1,19 @@
-import os
+import hashlib
 import json
+import os
+import shutil
+import time
+import urllib.error
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
 from snakemake.shell import shell
 
+base_url = snakemake.params.get("url", "https://www.encodeproject.org").rstrip("/")
+metadata_cache = snakemake.params.get("metadata_cache", "")
+retries = snakemake.params.get("retries", 3)
+connections = snakemake.params.get("connections", snakemake.threads)
+
 
 def exception_to_log(check, msg):
     log = snakemake.log_fmt_shell(stdout=True, stderr=True)
@@ -13,21 +23,64 @@ def exception_to_log(check, msg):
         os._exit(1)
 
 
-def download_encff(accession, layout, dest):
-    exception_to_log(
-        check=accession.startswith("ENCFF"),
-        msg=f"""Can't download accession "{accession}" directly as it isn't a file. This shouldn't happen..""",
-    )
-    url = f"https://www.encodeproject.org/files/{accession}/?format=json"
+def retry(func, *args):
+    """Call func, retrying with exponential backoff"""
+    for attempt in range(retries + 1):
+        try:
+            return func(*args)
+        except urllib.error.HTTPError as e:
+            # Client errors (e.g. an unknown accession) do not go away
+            if e.code < 500 or attempt == retries:
+                raise
+        except Exception:
+            if attempt == retries:
+                raise
+        time.sleep(2**attempt)
+
+
+def get_json(path, accession):
+    """Get an ENCODE JSON document, through the metadata cache if any"""
+    cached = ""
+    if metadata_cache:
+        key = hashlib.sha256(f"{base_url}{path}".encode()).hexdigest()
+        cached = os.path.join(metadata_cache, f"{key}.json")
+        if os.path.exists(cached):
+            with open(cached) as cached_file:
+                return json.load(cached_file)
+
     try:
-        response = urllib.request.urlopen(urllib.request.Request(url)).read()
-    except urllib.error.HTTPError:
+        response = retry(
+            lambda: urllib.request.urlopen(
+                urllib.request.Request(base_url + path)
+            ).read()
+        )
+    except urllib.error.URLError:
         exception_to_log(
             check=False,
             msg=f"""Having trouble connecting to ENCODE or the accesion "{accession}" doesn't exist.""",
         )
     response = json.loads(response.decode("utf-8"))
 
+    if cached:
+        os.makedirs(metadata_cache, exist_ok=True)
+        with open(f"{cached}.{os.getpid()}", "w") as cached_file:
+            json.dump(response, cached_file)
+        os.replace(f"{cached}.{os.getpid()}", cached)
+    return response
+
+
+def get_file(accession):
+    return get_json(f"/files/{accession}/?format=json", accession)
+
+
+def resolve_encff(accession, layout):
+    """Return the R1 and (for paired data) R2 file objects of a file accession"""
+    exception_to_log(
+        check=accession.startswith("ENCFF"),
+        msg=f"""Can't download accession "{accession}" directly as it isn't a file. This shouldn't happen..""",
+    )
+    response = get_file(accession)
+
     exception_to_log(
         check=response["file_format"] == "fastq",
         msg=f"""Can't download accession "{accession}" directly as it doesn't refer to a fastq file. It is a "{response["file_format"]}" file.""",
@@ -39,40 +92,21 @@ def download_encff(accession, layout, dest):
     )
 
     if layout == "single":
-        url = "https://www.encodeproject.org" + response["href"]
-        shell(f"wget -O - -o /dev/null {url} >> {dest.r1}")
-    if layout == "paired":
-        # lookup the mate
-        mate_accession = response["paired_with"].split("/")[2]
-        mate_url = f"https://www.encodeproject.org/files/{mate_accession}/?format=json"
-        mate_response = json.loads(
-            urllib.request.urlopen(urllib.request.Request(mate_url))
-            .read()
-            .decode("utf-8")
-        )
-
-        # get the urls to download them
-        url = "https://www.encodeproject.org" + response["href"]
-        mate_url = "https://www.encodeproject.org" + mate_response["href"]
-
-        # if the mate is actually R1, swap them so that R1 always corresponds
-        if response["paired_end"] == "2":
-            url, mate_url = mate_url, url
-
-        shell(f"wget -O - -o /dev/null {url} >> {dest.r1}")
-        shell(f"wget -O - -o /dev/null {mate_url} >> {dest.r2}")
-
-
-def download_encsr(accession, layout, dest):
-    url = f"https://www.encodeproject.org/search/?type=File&dataset=/experiments/{accession}/&file_format=fastq&format=json&frame=object"
-    try:
-        response = urllib.request.urlopen(urllib.request.Request(url)).read()
-    except urllib.error.HTTPError:
-        exception_to_log(
-            check=False,
-            msg=f"""Having trouble connecting to ENCODE or the accesion "{accession}" doesn't exist.""",
-        )
-    response = json.loads(response.decode("utf-8"))
+        return [response]
+    # lookup the mate
+    mate_response = get_file(response["paired_with"].split("/")[2])
+    # if the mate is actually R1, swap them so that R1 always corresponds
+    if response["paired_end"] == "2":
+        response, mate_response = mate_response, response
+    return [response, mate_response]
+
+
+def resolve_encsr(accession, layout):
+    """Return the R1 and (for paired data) R2 file objects of all runs of an experiment"""
+    response = get_json(
+        f"/search/?type=File&dataset=/experiments/{accession}/&file_format=fastq&format=json&frame=object&limit=all",
+        accession,
+    )
 
     # check if all run types are the same
     exception_to_log(
@@ -86,24 +120,49 @@ def download_encsr(accession, layout, dest):
             check=inferred_layout == "single-ended",
             msg=f"""The sample was automatically inferred to be single-ended, but it is: "{inferred_layout}".""",
         )
-        for encff_accession in response["@graph"]:
-            encff_accession = encff_accession["accession"]
-            download_encff(encff_accession, layout, dest)
+        return [[file] for file in response["@graph"]]
     elif layout == "paired":
         exception_to_log(
             check=inferred_layout == "paired-ended",
             msg=f"""The sample was automatically inferred to be paired-ended, but it is: "{inferred_layout}".""",
         )
-
-        # get all the R1s
-        runs = [x["accession"] for x in response["@graph"] if x["paired_end"] == "1"]
-
-        for run in runs:
-            download_encff(run, layout, dest)
+        # the search results hold both mates, no need to look them up again
+        files = {file["@id"]: file for file in response["@graph"]}
+        return [
+            [file, files[file["paired_with"]]]
+            for file in response["@graph"]
+            if file["paired_end"] == "1"
+        ]
     else:
         assert False
 
 
+def download(file, dest):
+    """Download a file object to dest, resuming partial downloads and checking its md5sum"""
+    if os.path.exists(dest):
+        return
+    url = base_url + file["href"]
+    partial = dest + ".part"
+
+    def fetch(url, partial):
+        shell("curl -sSfL --continue-at - --output {partial} {url} {log}")
+
+    retry(fetch, url, partial)
+
+    md5 = hashlib.md5()
+    with open(partial, "rb") as downloaded:
+        for block in iter(lambda: downloaded.read(1 << 20), b""):
+            md5.update(block)
+    if file.get("md5sum") and md5.hexdigest() != file["md5sum"]:
+        # A corrupt partial download cannot be resumed
+        os.remove(partial)
+        exception_to_log(
+            check=False,
+            msg=f"""The md5sum of "{file["accession"]}" does not match the one reported by ENCODE.""",
+        )
+    os.rename(partial, dest)
+
+
 # determine the layout (single-ended vs paired-ended)
 exception_to_log(
     check=len(snakemake.output) in [1, 2],
@@ -115,22 +174,48 @@ if len(snakemake.output) == 1:
         check=hasattr(snakemake.output, "r1"),
         msg=f"""Single-ended data needs to specify its output with r1.""",
     )
+    dests = [snakemake.output.r1]
 else:
     layout = "paired"
     exception_to_log(
         check=hasattr(snakemake.output, "r1") and hasattr(snakemake.output, "r2"),
         msg=f"""Paired-ended data needs to specify its output with r1 and r2.""",
     )
+    dests = [snakemake.output.r1, snakemake.output.r2]
 
 exception_to_log(
     check=snakemake.wildcards.accession.startswith(("ENCFF", "ENCSR")),
     msg=f"""The sample accession ({snakemake.wildcards.accession}) should start with ENCFF or ENCSR.""",
 )
 if snakemake.wildcards.accession.startswith("ENCFF"):
-    download_encff(
-        accession=snakemake.wildcards.accession, layout=layout, dest=snakemake.output
-    )
+    runs = [resolve_encff(snakemake.wildcards.accession, layout)]
 else:
-    download_encsr(
-        accession=snakemake.wildcards.accession, layout=layout, dest=snakemake.output
-    )
+    runs = resolve_encsr(snakemake.wildcards.accession, layout)
+
+
+# Downloads are kept until the outputs are written, so that a restarted job
+# only fetches the missing files and resumes the partial ones
+download_dir = snakemake.output.r1 + ".download"
+os.makedirs(download_dir, exist_ok=True)
+parts = [
+    [os.path.join(download_dir, f"{file['accession']}.fastq.gz") for file in run]
+    for run in runs
+]
+
+if snakemake.log:
+    open(snakemake.log[0], "w").close()
+log = snakemake.log_fmt_shell(stdout=True, stderr=True, append=True)
+
+with ThreadPoolExecutor(connections) as executor:
+    for job in [
+        executor.submit(download, file, part)
+        for run, run_parts in zip(runs, parts)
+        for file, part in zip(run, run_parts)
+    ]:
+        job.result()
+
+# gzip members can be concatenated, runs are joined in the order of ENCODE
+for mate, dest in enumerate(dests):
+    mate_parts = [run_parts[mate] for run_parts in parts]
+    shell("cat {mate_parts} > {dest}")
+shutil.rmtree(download_dir)
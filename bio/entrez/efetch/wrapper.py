@@ -1,24 +1,196 @@
-import subprocess as sp
+import hashlib
+import os
+import re
 import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
 if snakemake.log:
     sys.stderr = open(snakemake.log[0], "w")
 
-cmd = ["efetch"]
 
-
-def add_param(param, required=False):
+def get_param(param, required=False):
     if snakemake.params.get(param):
-        cmd.extend(["-" + param, snakemake.params[param]])
+        return snakemake.params[param]
     elif required:
         raise ValueError("Missing required parameter: " + param)
     else:
-        return []
+        return None
+
+
+ids = get_param("id", required=True)
+if isinstance(ids, str):
+    ids = ids.replace(",", " ").split()
+ids = [str(id) for id in ids]
+db = get_param("db")
+rettype = get_param("format")
+retmode = get_param("mode")
+
+url = snakemake.params.get(
+    "url", "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+)
+api_key = snakemake.params.get("api_key", os.environ.get("NCBI_API_KEY", ""))
+batch_size = snakemake.params.get("batch_size", 200)
+retries = snakemake.params.get("retries", 3)
+
+# NCBI allows 3 requests per second, or 10 with an API key
+rate = 10 if api_key else 3
+workers = max(1, min(snakemake.threads, rate)) if api_key else 1
+
+
+class RateLimit:
+    """Space out the requests of all threads by a minimal interval"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.next > now:
+                time.sleep(self.next - now)
+            self.next = max(now, self.next) + self.interval
+
+
+rate_limit = RateLimit(rate)
+
+
+def request(batch):
+    """POST an efetch request for a batch of ids, with retries and backoff"""
+    data = {"id": ",".join(batch)}
+    for key, value in (
+        ("db", db),
+        ("rettype", rettype),
+        ("retmode", retmode),
+        ("api_key", api_key),
+    ):
+        if value:
+            data[key] = value
+    data = urllib.parse.urlencode(data).encode()
+    for attempt in range(retries + 1):
+        rate_limit.wait()
+        try:
+            with urllib.request.urlopen(url, data=data) as response:
+                return response.read().decode()
+        except urllib.error.HTTPError as e:
+            # Too many requests and server errors are transient
+            if not (e.code == 429 or e.code >= 500) or attempt == retries:
+                raise
+        except urllib.error.URLError:
+            if attempt == retries:
+                raise
+        print(f"Retrying batch starting at {batch[0]}", file=sys.stderr)
+        time.sleep(2**attempt)
+
+
+def split_records(text):
+    """Split a response in records if its format allows to"""
+    lines = text.splitlines(keepends=True)
+    records = []
+    if lines and lines[0].startswith(">"):
+        # FASTA
+        for line in lines:
+            if line.startswith(">"):
+                records.append([])
+            records[-1].append(line)
+    elif lines and lines[0].startswith("LOCUS"):
+        # GenBank flat files, terminated by //
+        records.append([])
+        for line in lines:
+            if not records[-1] and not line.strip():
+                continue
+            records[-1].append(line)
+            if line.startswith("//"):
+                records.append([])
+        if not records[-1]:
+            records.pop()
+    else:
+        return None
+    return ["".join(record) for record in records]
+
+
+def accessions(record):
+    """Accessions, with and without version, of a FASTA or GenBank record"""
+    if record.startswith(">"):
+        names = record[1:].split(None, 1)[0].split("|")
+    else:
+        names = re.findall(r"^(?:ACCESSION|VERSION)\s+(\S+)", record, re.MULTILINE)
+    return set(names) | {name.split(".")[0] for name in names}
+
+
+def batch_path(batch):
+    """Cache path of a batch response which could not be split by id"""
+    key = hashlib.sha256(",".join(batch).encode()).hexdigest()
+    return os.path.join(cache, ".batches", key)
+
+
+def store(path, record):
+    with open(f"{path}.{os.getpid()}.{threading.get_ident()}", "w") as out:
+        out.write(record)
+        if record and not record.endswith("\n"):
+            out.write("\n")
+    os.replace(f"{path}.{os.getpid()}.{threading.get_ident()}", path)
+
+
+def fetch(batch):
+    """Fetch a batch and cache its records by id, or as a whole"""
+    response = request(batch)
+    records = split_records(response)
+    # Batches come back in the order asked for, which the accessions of the
+    # records confirm; UIDs and other formats are kept as one response
+    if (
+        records is not None
+        and len(records) == len(batch)
+        and all(id in accessions(record) for id, record in zip(batch, records))
+    ):
+        for id, record in zip(batch, records):
+            store(os.path.join(cache, id), record)
+    else:
+        store(batch_path(batch), response)
+
+
+def cached(id):
+    return os.path.exists(os.path.join(cache, id))
+
 
+with tempfile.TemporaryDirectory() as tmpdir:
+    # Without a cache directory, records only live for this job
+    cache = snakemake.params.get("cache", "") or tmpdir
+    cache = os.path.join(
+        cache, db or "default", f"{rettype or 'default'}.{retmode or 'default'}"
+    )
+    os.makedirs(os.path.join(cache, ".batches"), exist_ok=True)
 
-add_param("id", required=True)
-for param in ["db", "format", "mode"]:
-    add_param(param)
+    unique = list(dict.fromkeys(ids))
+    batches = [unique[i : i + batch_size] for i in range(0, len(unique), batch_size)]
+    missing = [
+        batch
+        for batch in batches
+        if not all(cached(id) for id in batch) and not os.path.exists(batch_path(batch))
+    ]
+    with ThreadPoolExecutor(workers) as executor:
+        for job in [executor.submit(fetch, batch) for batch in missing]:
+            job.result()
 
-with open(snakemake.output[0], "w") as out:
-    sp.run(cmd, stderr=sp.STDOUT, stdout=out, check=True)
+    # Records are written in the order of the ids, responses which could not
+    # be split at the position of their first id
+    batch_of = {id: batch for batch in batches for id in batch}
+    written = set()
+    with open(snakemake.output[0], "w") as out:
+        for id in ids:
+            if cached(id):
+                path = os.path.join(cache, id)
+            elif batch_path(batch_of[id]) not in written:
+                path = batch_path(batch_of[id])
+                written.add(path)
+            else:
+                continue
+            with open(path) as record:
+                out.write(record.read())
@@ -6,8 +6,10 @@ __email__ = "julianderuiter@gmail.com"
 __license__ = "MIT"
 
 
+from concurrent.futures import ThreadPoolExecutor
 from os import path
 import re
+import zipfile
 from tempfile import TemporaryDirectory
 from snakemake.shell import shell
 from snakemake_wrapper_utils.snakemake import get_mem
@@ -34,31 +36,89 @@ def basename_without_ext(file_path):
     return base
 
 
-# If you have multiple input files fastqc doesn't know what to do. Taking silently only first gives unapreciated results
+# Several input files are processed by a single fastqc run, in parallel if
+# threads allow; outputs are matched to the inputs by position
+inputs = list(snakemake.input)
+htmls = snakemake.output.html
+zips = snakemake.output.zip
+if isinstance(htmls, str):
+    htmls, zips = [htmls], [zips]
+if len(htmls) != len(inputs) or len(zips) != len(inputs):
+    raise IOError(
+        "Got {} input files, but {} html and {} zip output files; there should be one of each per input".format(
+            len(inputs), len(htmls), len(zips)
+        )
+    )
+output_bases = [basename_without_ext(fq) for fq in inputs]
+if len(set(output_bases)) != len(output_bases):
+    raise IOError(
+        "Input files must have different names, fastqc would overwrite outputs"
+    )
 
-if len(snakemake.input) > 1:
-    raise IOError("Got multiple input files, I don't know how to process them!")
+# Optionally run on a (deterministic) random subsample of the reads
+subsample = snakemake.params.get("subsample", None)
+seed = snakemake.params.get("seed", 11)
 
 # Run fastqc, since there can be race conditions if multiple jobs
 # use the same fastqc dir, we create a temp dir.
 with TemporaryDirectory() as tempdir:
+    if subsample:
+        if any(re.search("\\.(sam|bam)$", fq) for fq in inputs):
+            raise ValueError("subsampling is only supported for fastq inputs")
+        samples = [path.join(tempdir, base + ".fastq") for base in output_bases]
+        logs = [path.join(tempdir, base + ".seqtk.log") for base in output_bases]
+
+        def sample_reads(fq, sample, sample_log):
+            shell(
+                "seqtk sample -s {seed} {fq:q} {subsample} > {sample:q} 2> {sample_log:q}"
+            )
+
+        try:
+            with ThreadPoolExecutor(min(len(inputs), snakemake.threads)) as executor:
+                for job in [
+                    executor.submit(sample_reads, *args)
+                    for args in zip(inputs, samples, logs)
+                ]:
+                    job.result()
+        finally:
+            if snakemake.log:
+                shell("cat {logs} > {snakemake.log}")
+        log = snakemake.log_fmt_shell(stdout=True, stderr=True, append=True)
+    else:
+        samples = inputs
+
     shell(
         "fastqc"
         " --threads {snakemake.threads}"
         " --memory {mem_mb}"
         " {extra}"
         " --outdir {tempdir:q}"
-        " {snakemake.input[0]:q}"
+        " {samples:q}"
         " {log}"
     )
 
-    # Move outputs into proper position.
-    output_base = basename_without_ext(snakemake.input[0])
-    html_path = path.join(tempdir, output_base + "_fastqc.html")
-    zip_path = path.join(tempdir, output_base + "_fastqc.zip")
+    for fq, sample, output_base, html, zip_ in zip(
+        inputs, samples, output_bases, htmls, zips
+    ):
+        # Move outputs into proper position.
+        html_path = path.join(tempdir, output_base + "_fastqc.html")
+        zip_path = path.join(tempdir, output_base + "_fastqc.zip")
+
+        if subsample:
+            # Record how the reads were subsampled along with the statistics;
+            # inputs with fewer reads than requested are sampled in full
+            with open(sample) as sample_file:
+                sampled = sum(1 for _ in sample_file) // 4
+            with zipfile.ZipFile(zip_path, "a") as zip_file:
+                zip_file.writestr(
+                    output_base + "_fastqc/subsample.tsv",
+                    "file\trequested\tsampled\tseed\n{}\t{}\t{}\t{}\n".format(
+                        path.basename(fq), subsample, sampled, seed
+                    ),
+                )
 
-    if snakemake.output.html != html_path:
-        shell("mv {html_path:q} {snakemake.output.html:q}")
+        if html != html_path:
+            shell("mv {html_path:q} {html:q}")
 
-    if snakemake.output.zip != zip_path:
-        shell("mv {zip_path:q} {snakemake.output.zip:q}")
+        if zip_ != zip_path:
+            shell("mv {zip_path:q} {zip_:q}")
@@ -3,6 +3,7 @@ __copyright__ = "Copyright 2021, Patrik Smeds"
 __email__ = "patrik.smeds@gmail.com"
 __license__ = "MIT"
 
+import os
 import tempfile
 from snakemake.shell import shell
 from snakemake_wrapper_utils.java import get_java_opts
@@ -17,7 +18,9 @@ aln = snakemake.input.get("aln", "")
 if aln:
     aln = f"--input {aln}"
 
-contamination = snakemake.input.get("contemination_table", "")
+contamination = snakemake.input.get(
+    "contamination", snakemake.input.get("contemination_table", "")
+)
 if contamination:
     contamination = f"--contamination-table {contamination}"
 
@@ -27,13 +30,35 @@ if segmentation:
 
 f1r2 = snakemake.input.get("f1r2", "")
 if f1r2:
-    f1r2 = f"--orientation-bias-artifact-priors {f1r2}"
+    if isinstance(f1r2, str):
+        f1r2 = [f1r2]
+    f1r2 = " ".join(f"--orientation-bias-artifact-priors {prior}" for prior in f1r2)
+
+# Stats from Mutect2; several files (one per scattered Mutect2 shard)
+# are merged with MergeMutectStats first
+stats = snakemake.input.get("stats", "")
+if isinstance(stats, str):
+    stats = [stats] if stats else []
 
 intervals = snakemake.input.get("bed", "")
 if intervals:
     intervals = f"--intervals {intervals}"
 
 with tempfile.TemporaryDirectory() as tmpdir:
+    if len(stats) > 1:
+        merged_stats = os.path.join(tmpdir, "merged.stats")
+        stats_inputs = " ".join(f"--stats {shard}" for shard in stats)
+        shell(
+            "gatk --java-options '{java_opts}' MergeMutectStats"
+            " {stats_inputs}"
+            " --tmp-dir {tmpdir}"
+            " --output {merged_stats}"
+            " {log}"
+        )
+        stats = [merged_stats]
+        log = snakemake.log_fmt_shell(stdout=True, stderr=True, append=True)
+    stats = f"--stats {stats[0]}" if stats else ""
+
     shell(
         "gatk --java-options '{java_opts}' FilterMutectCalls"
         " --variant {snakemake.input.vcf}"
@@ -42,6 +67,7 @@ with tempfile.TemporaryDirectory() as tmpdir:
         " {contamination}"  # Tables containing contamination information
         " {segmentation}"  # Tumor segments' minor allele fractions
         " {f1r2}"  # .tar.gz files containing tables of prior artifact
+        " {stats}"  # Mutect2 stats
         " {intervals}"  # Genomic intervals over which to operate
         " {extra}"
         " --tmp-dir {tmpdir}"
@@ -6,6 +6,7 @@ __email__ = "thibault.dayris@gustaveroussy.fr"
 __license__ = "MIT"
 
 import os
+import shutil
 import tempfile
 from snakemake.shell import shell
 from snakemake.utils import makedirs
@@ -54,6 +55,11 @@ if snakemake.params.get("use_parallelgc", False):
         java_opts += f" -XX:ParallelGCThreads={snakemake.threads}"
 
 
+# Mutect2 always writes its stats next to the output VCF; they are moved
+# on user request, e.g. to be merged with MergeMutectStats when scattering
+stats = snakemake.output.get("stats", "")
+
+
 with tempfile.TemporaryDirectory() as tmpdir:
     shell(
         "gatk --java-options '{java_opts}' Mutect2"  # Tool and its subprocess
@@ -70,3 +76,6 @@ with tempfile.TemporaryDirectory() as tmpdir:
         " {bam_output}"  # Path to output bam file, optional
         " {log}"  # Logging behaviour
     )
+
+if stats and stats != snakemake.output.vcf + ".stats":
+    shutil.move(snakemake.output.vcf + ".stats", stats)
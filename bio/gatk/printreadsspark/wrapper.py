@@ -2,9 +2,45 @@ __author__ = "Filipe G. Vieira"
 __copyright__ = "Copyright 2021, Filipe G. Vieira"
 __license__ = "MIT"
 
+import os
 import tempfile
 from snakemake.shell import shell
 from snakemake_wrapper_utils.java import get_java_opts
+from snakemake_wrapper_utils.snakemake import is_arg
+
+
+def get_local_spark_opts(bams, tmpdir):
+    """
+    Obtain GATK and Spark arguments for a local Spark run.
+
+    Entries of `params.spark_conf` (and `params.bam_partition_size`) override
+    the defaults, while settings already given in `extra` or `spark_extra`
+    are kept.
+    """
+    partitions = snakemake.threads * 4
+    spark_conf = {
+        "spark.local.dir": tmpdir,
+        "spark.default.parallelism": partitions,
+    }
+    spark_conf.update(snakemake.params.get("spark_conf", {}))
+    spark_opts = " ".join(
+        "--conf '{}={}'".format(key, value)
+        for key, value in spark_conf.items()
+        if "{}=".format(key) not in spark_extra
+    )
+
+    gatk_opts = ""
+    if not is_arg("--bam-partition-size", extra):
+        # Enough input splits to keep all cores busy, within sensible bounds
+        size = sum(os.path.getsize(bam) for bam in bams)
+        bam_partition_size = snakemake.params.get(
+            "bam_partition_size",
+            min(max(size // partitions, 16 * 1024**2), 256 * 1024**2),
+        )
+        gatk_opts = "--bam-partition-size {}".format(bam_partition_size)
+
+    return gatk_opts, spark_opts
+
 
 log = snakemake.log_fmt_shell(stdout=True, stderr=True)
 
@@ -18,13 +54,21 @@ java_opts = get_java_opts(snakemake)
 
 
 with tempfile.TemporaryDirectory() as tmpdir:
+    gatk_spark_opts = spark_opts = ""
+    if spark_runner == "LOCAL" and spark_master.startswith("local"):
+        bams = snakemake.input.bam
+        gatk_spark_opts, spark_opts = get_local_spark_opts(
+            [bams] if isinstance(bams, str) else bams, tmpdir
+        )
+
     shell(
         "gatk --java-options '{java_opts}' PrintReadsSpark"
         " --input {snakemake.input.bam}"
         " --reference {snakemake.input.ref}"
         " {extra}"
+        " {gatk_spark_opts}"
         " --tmp-dir {tmpdir}"
         " --output {snakemake.output.bam}"
-        " -- --spark-runner {spark_runner} --spark-master {spark_master} {spark_extra}"
+        " -- --spark-runner {spark_runner} --spark-master {spark_master} {spark_opts} {spark_extra}"
         " {log}"
     )
@@ -3,8 +3,14 @@ __copyright__ = "Copyright 2020, David Lähnemann"
 __email__ = "david.laehnemann@uni-due.de"
 __license__ = "MIT"
 
-from snakemake.shell import shell
 import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from snakemake.shell import shell
 
 log = snakemake.log_fmt_shell(stdout=True, stderr=True)
 
@@ -20,7 +26,6 @@ if token_file == "":
 token = ""
 with open(token_file) as tf:
     token = tf.read()
-os.environ["CURL_HEADER_TOKEN"] = "'X-Auth-Token: {}'".format(token)
 
 slices = snakemake.params.get("slices", "")
 if slices == "":
@@ -29,19 +34,89 @@ if slices == "":
     )
 
 extra = snakemake.params.get("extra", "")
+base_url = snakemake.params.get("url", "https://api.gdc.cancer.gov").rstrip("/")
+slices_per_request = snakemake.params.get("slices_per_request", 20)
+retries = snakemake.params.get("retries", 3)
+connections = snakemake.params.get("connections", snakemake.threads)
+
+slices = slices.split("&")
+requests = [
+    "&".join(slices[i : i + slices_per_request])
+    for i in range(0, len(slices), slices_per_request)
+]
+
+bam = snakemake.output.bam
+bai = snakemake.output.get("bai", "")
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    # Keeps the token off the command lines
+    header = os.path.join(tmpdir, "header.txt")
+    with open(header, "w") as header_file:
+        header_file.write("X-Auth-Token: {}\n".format(token.strip()))
+
+    parts = [os.path.join(tmpdir, f"part.{i}.bam") for i in range(len(requests))]
+    logs = [os.path.join(tmpdir, f"part.{i}.log") for i in range(len(requests))]
+
+    def fetch_slices(request, part, part_log):
+        url = f"{base_url}/slicing/view/{uuid}?{request}"
+        for attempt in range(retries + 1):
+            status = ""
+            try:
+                status = "".join(
+                    shell(
+                        "curl --silent --show-error"
+                        " --header @{header}"
+                        " --write-out '%{{http_code}}'"
+                        " {extra}"
+                        " --output {part} {url:q} 2>> {part_log}",
+                        iterable=True,
+                    )
+                )
+            except subprocess.CalledProcessError:
+                # Connection problems are retried
+                pass
+            if status.startswith("2"):
+                return
+            if status and not (status.startswith("5") or status == "429"):
+                break
+            if attempt < retries:
+                time.sleep(2**attempt)
+        # Error responses carry their message in the body
+        with open(part_log, "a") as log_file:
+            print(f"HTTP status {status or 'unknown'} for {request}", file=log_file)
+            if os.path.exists(part):
+                with open(part, errors="replace") as body:
+                    log_file.write(body.read(100000))
+        raise RuntimeError(
+            "Your GDC API request returned an error, check your log file for the error message."
+        )
+
+    try:
+        with ThreadPoolExecutor(connections) as executor:
+            for job in [
+                executor.submit(fetch_slices, *args)
+                for args in zip(requests, parts, logs)
+            ]:
+                job.result()
+    finally:
+        if snakemake.log:
+            shell("cat {logs} > {snakemake.log}")
 
-shell(
-    "curl --silent"
-    " --header $CURL_HEADER_TOKEN"
-    " 'https://api.gdc.cancer.gov/slicing/view/{uuid}?{slices}'"
-    " {extra}"
-    " --output {snakemake.output.bam} {log}"
-)
-
-if os.path.getsize(snakemake.output.bam) < 100000:
-    with open(snakemake.output.bam) as f:
-        if "error" in f.read():
-            shell("cat {snakemake.output.bam} {log}")
-            raise RuntimeError(
-                "Your GDC API request returned an error, check your log file for the error message."
-            )
+    log = snakemake.log_fmt_shell(stdout=True, stderr=True, append=True)
+    if len(parts) == 1:
+        shutil.move(parts[0], bam)
+    else:
+        # Reads covered by slices of different requests (overlapping regions,
+        # genes and regions, mates) come back once per request. The parts
+        # share their header, and exact duplicates are adjacent to their
+        # original within the records at the same position of the merge.
+        shell(
+            "(samtools merge -c -p -u -o - {parts}"
+            " | samtools view -h -"
+            " | awk -F '\\t' '/^@/ {{print; next}}"
+            " $3 != chrom || $4 != pos {{delete seen; chrom = $3; pos = $4}}"
+            " !seen[$0]++'"
+            " | samtools view -b -@ {snakemake.threads} -o {bam} -) {log}"
+        )
+    if bai:
+        shell("samtools index -@ {snakemake.threads} {bam} {bai} {log}")
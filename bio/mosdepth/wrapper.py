@@ -3,9 +3,112 @@ __copyright__ = "Copyright 2020, William Rowell"
 __email__ = "wrowell@pacb.com"
 __license__ = "MIT"
 
+import os
 import sys
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
 from snakemake.shell import shell
 
+
+def contig_groups(contigs, groups):
+    """Split (contig, length) pairs in consecutive groups of balanced length"""
+    total = sum(length for _, length in contigs)
+
+    splits = [[]]
+    seen = 0
+    for contig, length in contigs:
+        if splits[-1] and len(splits) < groups and seen >= total * len(splits) / groups:
+            splits.append([])
+        splits[-1].append(contig)
+        seen += length
+    return splits
+
+
+def read_histogram(path):
+    """Read the `depth<TAB>bases` lines of a histogram"""
+    hist = Counter()
+    with open(path) as hist_file:
+        for line in hist_file:
+            depth, bases = line.split()
+            hist[int(depth)] += int(bases)
+    return hist
+
+
+def write_distribution(name, hist, out_file):
+    """Write the cumulative coverage distribution of a histogram as mosdepth does"""
+    total = sum(hist.values())
+    if total < 1:
+        return
+    cum = 0.0
+    for depth in range(max(hist), -1, -1):
+        # Proportion of bases covered by at least `depth` reads
+        if depth > 300 and not hist[depth]:
+            continue
+        cum += hist[depth] / total
+        if cum < 8e-5:
+            continue
+        print(name, depth, "{:.2f}".format(cum), sep="\t", file=out_file)
+
+
+def merge_summaries(parts, contigs, output):
+    """Merge per-contig summaries and recompute the totals"""
+    header = None
+    lines = []
+    totals = {"total": [0, 0, None, None], "total_region": [0, 0, None, None]}
+    for part, contig in zip(parts, contigs):
+        with open(part) as part_file:
+            header = next(part_file)
+            for line in part_file:
+                name, length, bases, _, low, high = line.rstrip("\n").split("\t")
+                if name == contig:
+                    total = totals["total"]
+                elif name == contig + "_region":
+                    total = totals["total_region"]
+                else:
+                    continue
+                lines.append(line)
+                total[0] += int(length)
+                total[1] += int(bases)
+                total[2] = int(low) if total[2] is None else min(total[2], int(low))
+                total[3] = int(high) if total[3] is None else max(total[3], int(high))
+
+    with open(output, "w") as out_file:
+        out_file.write(header)
+        out_file.writelines(lines)
+        for name, (length, bases, low, high) in totals.items():
+            if low is None:
+                continue
+            mean = bases / length if length else 0
+            print(
+                name,
+                length,
+                bases,
+                "{:.2f}".format(mean),
+                low,
+                high,
+                sep="\t",
+                file=out_file,
+            )
+
+
+def merge_distributions(parts, hists, output):
+    """Concatenate per-contig distributions and recompute the total one"""
+    total = Counter()
+    for hist in hists:
+        total.update(read_histogram(hist))
+    with open(output, "w") as out_file:
+        for part in parts:
+            if not os.path.exists(part):
+                continue
+            with open(part) as part_file:
+                out_file.writelines(
+                    line for line in part_file if not line.startswith("total\t")
+                )
+        write_distribution("total", total, out_file)
+
+
 extra = snakemake.params.get("extra", "")
 log = snakemake.log_fmt_shell(stdout=True, stderr=True)
 
@@ -24,6 +127,7 @@ if bed:
 quantize_out = False
 thresholds_out = False
 regions_bed_out = False
+global_dist_out = False
 region_dist_out = False
 for file in snakemake.output:
     if ".per-base." in file and "--no-per-base" in extra:
@@ -34,6 +138,8 @@ for file in snakemake.output:
         quantize_out = True
     if ".thresholds.bed.gz" in file:
         thresholds_out = True
+    if ".mosdepth.global.dist.txt" in file:
+        global_dist_out = True
     if ".mosdepth.region.dist.txt" in file:
         region_dist_out = True
     if ".regions.bed.gz" in file:
@@ -103,6 +209,119 @@ threads = "" if snakemake.threads <= 1 else "--threads {}".format(snakemake.thre
 prefix = snakemake.output.summary.replace(".mosdepth.summary.txt", "")
 
 
-shell(
-    "({precision} mosdepth {threads} {fasta} {by} {quantize} {thresholds} {extra} {prefix} {snakemake.input.bam}) {log}"
-)
+if not snakemake.params.get("per_contig", False):
+    shell(
+        "({precision} mosdepth {threads} {fasta} {by} {quantize} {thresholds} {extra} {prefix} {snakemake.input.bam}) {log}"
+    )
+else:
+    # Per-contig mode: contigs are split in `threads` groups of balanced
+    # length, each group running single-threaded mosdepth on its contigs in
+    # turn (`--chrom` takes a single contig). The `total` lines of the
+    # distributions are rebuilt from the per-base depths, which are only
+    # computed when they are an output or a distribution is.
+    bam = snakemake.input.bam
+    per_base_out = not {"-n", "--no-per-base"} & set(extra.split())
+    per_base = per_base_out or global_dist_out or region_dist_out
+    part_extra = " ".join(
+        arg
+        for arg in extra.split()
+        if not per_base or arg not in ("-n", "--no-per-base")
+    )
+
+    contigs = [
+        line.split("\t")[:2]
+        for line in shell("samtools idxstats {bam}", iterable=True)
+        if not line.startswith("*\t")
+    ]
+    groups = contig_groups(
+        [(contig, int(length)) for contig, length in contigs], snakemake.threads
+    )
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Contigs and part prefixes are listed in files, as there can be
+        # too many of them for a command line
+        parts = []
+        lists = [os.path.join(tmpdir, f"group.{i}") for i in range(len(groups))]
+        logs = [group_list + ".log" for group_list in lists]
+        for group, group_list in zip(groups, lists):
+            with open(group_list, "w") as list_file:
+                for contig in group:
+                    parts.append(os.path.join(tmpdir, f"part.{len(parts)}"))
+                    print(contig, parts[-1], sep="\t", file=list_file)
+        part_list = os.path.join(tmpdir, "parts")
+        shell("cat {lists} > {part_list}")
+
+        def depth(group_list, group_log):
+            shell(
+                "(while read contig part; do"
+                " {precision} mosdepth --chrom $contig {fasta} {by} {quantize} {thresholds} {part_extra} $part {bam};"
+                " done < {group_list}) > {group_log} 2>&1"
+            )
+            # Bases per depth over the contigs of the group, whole and in regions
+            per_bases = f"while read contig part; do zcat $part.per-base.bed.gz; done < {group_list}"
+            if global_dist_out or (region_dist_out and not bed):
+                shell(
+                    "({per_bases})"
+                    " | awk '{{hist[$4] += $3 - $2}} END {{for (d in hist) printf \"%s\\t%.0f\\n\", d, hist[d]}}'"
+                    " > {group_list}.global.hist 2>> {group_log}"
+                )
+            if region_dist_out and bed:
+                # Overlapping regions count their shared bases twice, as in mosdepth
+                shell(
+                    "({per_bases})"
+                    " | bedtools intersect -wo -a stdin -b {bed}"
+                    " | awk '{{hist[$4] += $NF}} END {{for (d in hist) printf \"%s\\t%.0f\\n\", d, hist[d]}}'"
+                    " > {group_list}.region.hist 2>> {group_log}"
+                )
+            elif region_dist_out:
+                # Windows tile the contigs
+                shell("cp {group_list}.global.hist {group_list}.region.hist")
+
+        try:
+            with ThreadPoolExecutor(len(groups)) as executor:
+                for job in [executor.submit(depth, *args) for args in zip(lists, logs)]:
+                    job.result()
+        finally:
+            if snakemake.log:
+                shell("cat {logs} > {snakemake.log}")
+
+        log = snakemake.log_fmt_shell(stdout=True, stderr=True, append=True)
+
+        beds = [".thresholds.bed.gz"] * bool(thresholds)
+        beds += [".per-base.bed.gz"] * per_base_out
+        beds += [".regions.bed.gz"] * bool(by)
+        beds += [".quantized.bed.gz"] * bool(quantize)
+        for ext in beds:
+            if ext == ".thresholds.bed.gz":
+                # Keep the column header of the first part only
+                shell(
+                    "((skip=1; while read contig part; do"
+                    " zcat $part{ext} | tail -n +$skip; skip=2;"
+                    " done < {part_list})"
+                    " | bgzip > {prefix}{ext}) {log}"
+                )
+            else:
+                # BGZF files can be concatenated as they are
+                shell(
+                    "(while read contig part; do cat $part{ext}; done < {part_list})"
+                    " > {prefix}{ext}"
+                )
+            shell("tabix --csi --preset bed --force {prefix}{ext} {log}")
+
+        merge_summaries(
+            [part + ".mosdepth.summary.txt" for part in parts],
+            [contig for contig, _ in contigs],
+            snakemake.output.summary,
+        )
+        if global_dist_out:
+            merge_distributions(
+                [part + ".mosdepth.global.dist.txt" for part in parts],
+                [group_list + ".global.hist" for group_list in lists],
+                prefix + ".mosdepth.global.dist.txt",
+            )
+        if region_dist_out:
+            merge_distributions(
+                [part + ".mosdepth.region.dist.txt" for part in parts],
+                [group_list + ".region.hist" for group_list in lists],
+                prefix + ".mosdepth.region.dist.txt",
+            )
@@ -8,12 +8,96 @@ __license__ = "MIT"
 
 # No need for explicit temp folder, since MultiQC already uses TMPDIR (https://multiqc.info/docs/usage/troubleshooting/#no-space-left-on-device)
 
+import fcntl
+import json
+import os
+import tempfile
 from pathlib import Path
 from snakemake.shell import shell
 from snakemake_wrapper_utils.snakemake import is_arg
 
 
+def used_files(paths, cache):
+    """
+    Return the files under `paths` which MultiQC takes data from
+
+    The outcome is cached per file (keyed by path, mtime and size) in
+    `cache`, so that only new or changed files are searched by MultiQC.
+    Every file under `paths` is still listed and stat'ed on each run.
+    """
+    files = {}
+    for path in map(os.path.abspath, paths):
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in names:
+                    files[os.path.join(root, name)] = None
+        else:
+            files[path] = None
+    for file in files:
+        stat = os.stat(file)
+        files[file] = [stat.st_mtime_ns, stat.st_size]
+
+    cache_file = os.path.join(cache, "sources.json")
+    sources = {}
+    if os.path.exists(cache_file):
+        with open(cache_file) as cache_json:
+            sources = json.load(cache_json)
+    # Forget files that vanished since last run
+    sources = {file: source for file, source in sources.items() if os.path.exists(file)}
+
+    stale = [
+        file for file, key in files.items() if sources.get(file, {}).get("key") != key
+    ]
+    if stale:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file_list = os.path.join(tmpdir, "files.txt")
+            with open(file_list, "w") as file_list_file:
+                print(*stale, sep="\n", file=file_list_file)
+            shell(
+                "multiqc"
+                " {user_extra}"
+                " --no-report --data-dir --data-format tsv --force"
+                " --outdir {tmpdir}"
+                " --filename sources"
+                " --file-list {file_list}"
+                " {log}"
+            )
+            modules = {file: set() for file in stale}
+            sources_tsv = os.path.join(tmpdir, "sources_data", "multiqc_sources.txt")
+            if os.path.exists(sources_tsv):
+                with open(sources_tsv) as sources_file:
+                    next(sources_file)
+                    for line in sources_file:
+                        module, _, _, source = line.rstrip("\n").split("\t")
+                        if source in modules:
+                            modules[source].add(module)
+        for file in stale:
+            sources[file] = {"key": files[file], "modules": sorted(modules[file])}
+
+        # Reports sharing the cache may have updated it meanwhile, so merge
+        # into its current content under an exclusive lock
+        os.makedirs(cache, exist_ok=True)
+        with open(cache_file + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            merged = {}
+            if os.path.exists(cache_file):
+                with open(cache_file) as cache_json:
+                    merged = json.load(cache_json)
+            merged = {
+                file: source for file, source in merged.items() if os.path.exists(file)
+            }
+            merged.update((file, sources[file]) for file in stale)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=cache, suffix=".tmp", delete=False
+            ) as cache_json:
+                json.dump(merged, cache_json, indent=1)
+            os.replace(cache_json.name, cache_file)
+
+    return [file for file in files if sources[file]["modules"]]
+
+
 extra = snakemake.params.get("extra", "")
+user_extra = extra
 log = snakemake.log_fmt_shell(stdout=True, stderr=True)
 
 
@@ -25,6 +109,10 @@ if not use_input_files_only:
 else:
     input_data = set(snakemake.input)
 
+# Directory caching which inputs MultiQC takes data from, so that unchanged
+# files are not searched again and unused ones are left out of the report run
+cache = snakemake.params.get("cache", "")
+
 
 # Add extra options depending on output files
 no_report = True
@@ -49,14 +137,30 @@ out_dir = Path(snakemake.output[0]).parent
 file_name = Path(snakemake.output[0]).with_suffix("").name
 
 
-shell(
-    "multiqc"
-    " {extra}"
-    " --outdir {out_dir}"
-    " --filename {file_name}"
-    " {input_data}"
-    " {log}"
-)
+if cache:
+    files = used_files(sorted(input_data), cache)
+    log = snakemake.log_fmt_shell(stdout=True, stderr=True, append=True)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_list = os.path.join(tmpdir, "files.txt")
+        with open(file_list, "w") as file_list_file:
+            print(*files, sep="\n", file=file_list_file)
+        shell(
+            "multiqc"
+            " {extra}"
+            " --outdir {out_dir}"
+            " --filename {file_name}"
+            " --file-list {file_list}"
+            " {log}"
+        )
+else:
+    shell(
+        "multiqc"
+        " {extra}"
+        " --outdir {out_dir}"
+        " --filename {file_name}"
+        " {input_data}"
+        " {log}"
+    )
 
 
 # Move files to another destination (if needed)
@@ -3,6 +3,10 @@ __copyright__ = "Copyright 2016, Johannes Köster"
 __email__ = "koester@jimmy.harvard.edu"
 __license__ = "MIT"
 
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 from snakemake.shell import shell
 
 extra = snakemake.params.get("extra", "")
@@ -22,13 +26,67 @@ if exclude_bed:
 
 output_prefix = snakemake.output[0].rsplit("_", 1)[0]
 
-shell(
-    "pindel "
-    "-T {snakemake.threads} "
-    "{extra} "
-    "{include_bed} "
-    "{exclude_bed} "
-    "-i {snakemake.input.config} "
-    "-f {snakemake.input.ref} "
-    "-o {output_prefix} {log}"
-)
+# Optionally call each chromosome with its own pindel process (`-c`);
+# `True` means all the contigs of the reference index, in their order
+chromosomes = snakemake.params.get("chromosomes", [])
+if chromosomes is True:
+    with open(snakemake.input.ref + ".fai") as fai:
+        chromosomes = [line.split("\t")[0] for line in fai]
+
+if not chromosomes:
+    shell(
+        "pindel "
+        "-T {snakemake.threads} "
+        "{extra} "
+        "{include_bed} "
+        "{exclude_bed} "
+        "-i {snakemake.input.config} "
+        "-f {snakemake.input.ref} "
+        "-o {output_prefix} {log}"
+    )
+else:
+    # Concurrent processes are bounded by the threads, and by the memory
+    # budget when the expected memory usage of one process is known
+    jobs = min(len(chromosomes), snakemake.threads)
+    chrom_mem_mb = snakemake.params.get("chrom_mem_mb", 0)
+    if chrom_mem_mb:
+        jobs = max(1, min(jobs, snakemake.resources.get("mem_mb", 0) // chrom_mem_mb))
+    threads = max(1, snakemake.threads // jobs)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        prefixes = [os.path.join(tmpdir, str(i)) for i in range(len(chromosomes))]
+
+        def call(chromosome, prefix):
+            shell(
+                "pindel "
+                "-T {threads} "
+                "{extra} "
+                "{include_bed} "
+                "{exclude_bed} "
+                "-i {snakemake.input.config} "
+                "-f {snakemake.input.ref} "
+                "-c {chromosome} "
+                "-o {prefix} "
+                "> {prefix}.log 2>&1"
+            )
+
+        try:
+            with ThreadPoolExecutor(jobs) as executor:
+                for job in [
+                    executor.submit(call, *args) for args in zip(chromosomes, prefixes)
+                ]:
+                    job.result()
+        finally:
+            if snakemake.log:
+                logs = [f"{prefix}.log" for prefix in prefixes]
+                shell("cat {logs} > {snakemake.log}")
+
+        # Per-chromosome outputs are concatenated in chromosome order
+        for output in snakemake.output:
+            variant_type = output[len(output_prefix) + 1 :]
+            with open(output, "w") as merged:
+                for prefix in prefixes:
+                    part = f"{prefix}_{variant_type}"
+                    if os.path.exists(part):
+                        with open(part) as records:
+                            merged.writelines(records)
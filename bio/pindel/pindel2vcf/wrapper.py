@@ -5,6 +5,8 @@ __license__ = "MIT"
 
 import os
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 from snakemake.shell import shell
 
 extra = snakemake.params.get("extra", "")
@@ -68,6 +70,45 @@ with tempfile.TemporaryDirectory() as tmpdirname:
                 os.path.join(tmpdirname, os.path.basename(variant_input)),
             )
         input_file = os.path.join(tmpdirname, input_name)
-    shell(
-        "pindel2vcf {snakemake.params.extra} {input_flag} {input_file} -r {snakemake.input.ref} -R {snakemake.params.refname} -d {snakemake.params.refdate} -v {snakemake.output[0]} {log}"
-    )
+
+    # Optionally convert each chromosome with its own pindel2vcf process
+    # (`-c`); `True` means all the contigs of the reference index
+    chromosomes = snakemake.params.get("chromosomes", [])
+    if chromosomes is True:
+        with open(snakemake.input.ref + ".fai") as fai:
+            chromosomes = [line.split("\t")[0] for line in fai]
+
+    if not chromosomes:
+        shell(
+            "pindel2vcf {snakemake.params.extra} {input_flag} {input_file} -r {snakemake.input.ref} -R {snakemake.params.refname} -d {snakemake.params.refdate} -v {snakemake.output[0]} {log}"
+        )
+    else:
+        vcfs = [
+            os.path.join(tmpdirname, "{}.vcf".format(i))
+            for i in range(len(chromosomes))
+        ]
+
+        def convert(chromosome, vcf):
+            shell(
+                "pindel2vcf {snakemake.params.extra} {input_flag} {input_file} -r {snakemake.input.ref} -R {snakemake.params.refname} -d {snakemake.params.refdate} -c {chromosome} -v {vcf} > {vcf}.log 2>&1"
+            )
+
+        try:
+            with ThreadPoolExecutor(snakemake.threads) as executor:
+                for job in [
+                    executor.submit(convert, *args) for args in zip(chromosomes, vcfs)
+                ]:
+                    job.result()
+        finally:
+            if snakemake.log:
+                logs = [vcf + ".log" for vcf in vcfs]
+                shell("cat {logs} > {snakemake.log}")
+
+        # Records are concatenated in chromosome order, below the header
+        # of the first chromosome
+        with open(snakemake.output[0], "w") as merged:
+            for i, vcf in enumerate(vcfs):
+                with open(vcf) as records:
+                    merged.writelines(
+                        line for line in records if i == 0 or not line.startswith("#")
+                    )
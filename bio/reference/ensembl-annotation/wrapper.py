@@ -3,12 +3,205 @@ __copyright__ = "Copyright 2019, Johannes Köster"
 __email__ = "johannes.koester@uni-due.de"
 __license__ = "MIT"
 
+import fcntl
+import hashlib
+import os
 import subprocess
 import sys
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from snakemake.shell import shell
 
 
+def parse_attributes(attributes, out_fmt):
+    """Parse the attribute column of a GTF or GFF3 record"""
+    if out_fmt == "gtf":
+        return dict(
+            attribute.strip().split(" ", 1)
+            for attribute in attributes.rstrip("; ").split("; ")
+            if " " in attribute.strip()
+        )
+    return dict(
+        attribute.split("=", 1)
+        for attribute in attributes.split(";")
+        if "=" in attribute
+    )
+
+
+def cached_download(url, dest, cache, max_size=None, log=""):
+    """
+    Download url to dest through a shared download cache
+
+    Entries are keyed by the URL and the validators of its headers (ETag,
+    Last-Modified, Content-Length). Every entry is fetched once under a
+    lock, moved in place when complete and hardlinked to dest (copied,
+    reflinked if possible, across filesystems). Beyond max_size bytes,
+    the least recently used entries are evicted along with their locks.
+    Returns the entry.
+    """
+
+    def lock(path, flags=fcntl.LOCK_EX):
+        # The lock file of an evicted entry may be removed while waiting
+        # for it, in which case the new one is locked instead
+        while True:
+            lock_file = open(path + ".lock", "a")
+            try:
+                fcntl.flock(lock_file, flags)
+            except BlockingIOError:
+                lock_file.close()
+                return None
+            try:
+                if os.path.samestat(
+                    os.fstat(lock_file.fileno()), os.stat(lock_file.name)
+                ):
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+
+    headers = {}
+    try:
+        for line in shell("curl -sSfIL {url} 2> /dev/null", iterable=True):
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+    except subprocess.CalledProcessError:
+        # Servers refusing HEAD requests are keyed by URL only
+        pass
+    validators = [
+        headers.get(h, "") for h in ("etag", "last-modified", "content-length")
+    ]
+    key = hashlib.sha256("\t".join([url, *validators]).encode()).hexdigest()
+
+    os.makedirs(cache, exist_ok=True)
+    entry = os.path.join(cache, key)
+    # Concurrent jobs wait for the first one to populate the entry
+    with lock(entry):
+        if not os.path.exists(entry):
+            partial = entry + ".part"
+            shell("curl -sSfL --continue-at - --output {partial} {url} {log}")
+            os.rename(partial, entry)
+        os.utime(entry)
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(entry, dest)
+        except OSError:
+            shell("cp --reflink=auto {entry} {dest}")
+
+    if max_size:
+        entries = []
+        for candidate in os.scandir(cache):
+            if len(candidate.name) == len(key):
+                try:
+                    stat = candidate.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, candidate.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= max_size:
+                break
+            if path == entry:
+                continue
+            # Entries being populated or linked are kept
+            evicted = lock(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if evicted is None:
+                continue
+            with evicted:
+                if os.path.exists(path):
+                    os.remove(path)
+                os.remove(path + ".lock")
+            total -= size
+    return entry
+
+
+def write_sidecars(annotation, out_fmt, tx2gene, genes, exons, introns):
+    """Write transcript-to-gene table and gene, exon and intron BEDs of an annotation"""
+    gene_names = {}
+    gene_records = []
+    transcript_genes = {}
+    transcript_exons = defaultdict(list)
+    with open(annotation) as records:
+        for record in records:
+            if record.startswith("#"):
+                continue
+            chrom, _, feature, start, end, _, strand, _, attributes = record.rstrip(
+                "\n"
+            ).split("\t")
+            attributes = {
+                key: value.strip('"')
+                for key, value in parse_attributes(attributes, out_fmt).items()
+            }
+            start = int(start) - 1
+            end = int(end)
+            if out_fmt == "gtf":
+                gene_id = attributes.get("gene_id")
+                transcript_id = attributes.get("transcript_id")
+                if feature == "gene":
+                    gene_records.append((chrom, start, end, gene_id, strand))
+                    gene_names[gene_id] = attributes.get("gene_name", "")
+                elif feature == "transcript":
+                    transcript_genes[transcript_id] = gene_id
+                elif feature == "exon":
+                    transcript_exons[transcript_id].append((chrom, start, end, strand))
+            else:
+                record_id = attributes.get("ID", "")
+                parents = attributes.get("Parent", "").split(",")
+                if record_id.startswith("gene:"):
+                    gene_id = record_id[len("gene:") :]
+                    gene_records.append((chrom, start, end, gene_id, strand))
+                    gene_names[gene_id] = attributes.get("Name", "")
+                elif record_id.startswith("transcript:"):
+                    for parent in parents:
+                        if parent.startswith("gene:"):
+                            transcript_genes[record_id[len("transcript:") :]] = parent[
+                                len("gene:") :
+                            ]
+                elif feature == "exon":
+                    for parent in parents:
+                        if parent.startswith("transcript:"):
+                            transcript_exons[parent[len("transcript:") :]].append(
+                                (chrom, start, end, strand)
+                            )
+
+    if tx2gene:
+        with open(tx2gene, "w") as out:
+            print("transcript_id", "gene_id", "gene_name", sep="\t", file=out)
+            for transcript_id, gene_id in transcript_genes.items():
+                print(
+                    transcript_id,
+                    gene_id,
+                    gene_names.get(gene_id, ""),
+                    sep="\t",
+                    file=out,
+                )
+    if genes:
+        with open(genes, "w") as out:
+            for chrom, start, end, gene_id, strand in sorted(gene_records):
+                print(chrom, start, end, gene_id, 0, strand, sep="\t", file=out)
+    if exons or introns:
+        exon_records = []
+        intron_records = []
+        for transcript_id, transcript in transcript_exons.items():
+            transcript.sort()
+            for chrom, start, end, strand in transcript:
+                exon_records.append((chrom, start, end, transcript_id, strand))
+            for (chrom, _, start, strand), (_, end, _, _) in zip(
+                transcript, transcript[1:]
+            ):
+                if start < end:
+                    intron_records.append((chrom, start, end, transcript_id, strand))
+        for bed, bed_records in ((exons, exon_records), (introns, intron_records)):
+            if bed:
+                with open(bed, "w") as out:
+                    for chrom, start, end, name, strand in sorted(bed_records):
+                        print(chrom, start, end, name, 0, strand, sep="\t", file=out)
+
+
 log = snakemake.log_fmt_shell(stdout=False, stderr=True)
 
 
@@ -48,7 +241,9 @@ else:
     )
 
 
-url = "ftp://ftp.ensembl.org/pub/{branch}release-{release}/{out_fmt}/{species}/{species_cap}.{build}.{gtf_release}.{flavor}{suffix}".format(
+base_url = snakemake.params.get("url", "ftp://ftp.ensembl.org/pub").rstrip("/")
+url = "{base_url}/{branch}release-{release}/{out_fmt}/{species}/{species_cap}.{build}.{gtf_release}.{flavor}{suffix}".format(
+    base_url=base_url,
     release=release,
     gtf_release=gtf_release,
     build=build,
@@ -61,11 +256,87 @@ url = "ftp://ftp.ensembl.org/pub/{branch}release-{release}/{out_fmt}/{species}/{
 )
 
 
+annotation = snakemake.output[0]
+index = snakemake.output.get("index", "")
+if index and not out_gz:
+    raise ValueError("an index output needs a bgzip compressed output (*.gz)")
+sidecars = {
+    name: snakemake.output.get(name, "")
+    for name in ("tx2gene", "genes", "exons", "introns")
+}
+
+cache = snakemake.params.get(
+    "cache", os.environ.get("SNAKEMAKE_WRAPPERS_DOWNLOAD_CACHE", "")
+)
+cache_size = snakemake.params.get(
+    "cache_size", os.environ.get("SNAKEMAKE_WRAPPERS_DOWNLOAD_CACHE_SIZE", "")
+)
+max_size = float(cache_size) * 1024**3 if cache_size else None
+
+
 try:
-    if out_gz:
-        shell("curl -L {url} > {snakemake.output[0]} {log}")
-    else:
-        shell("(curl -L {url} | gzip -d > {snakemake.output[0]}) {log}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = f"curl -sSfL {url}"
+        if cache:
+            cached = os.path.join(tmpdir, os.path.basename(url))
+            cached_download(url, cached, cache, max_size, log)
+            source = f"cat {cached}"
+
+        # Sidecars are computed from a copy of the decompressed stream
+        stream = os.path.join(tmpdir, "stream")
+        tee = ""
+        if any(sidecars.values()):
+            os.mkfifo(stream)
+            tee = f"| tee --output-error=warn-nopipe {stream}"
+
+        if index:
+            # Headers stay on top (without GFF3 "###" separators), records
+            # are sorted by position. The header is written out once sort
+            # starts emitting, i.e. after the whole input has been split.
+            header = os.path.join(tmpdir, "header")
+            open(header, "w").close()
+            download = (
+                "{source} | gzip -d {tee}"
+                " | awk -v header={header} '/^###$/ {{next}} /^#/ {{print > header; next}} 1'"
+                " | LC_ALL=C sort --stable -t $'\\t' -k1,1 -k4,4n -k5,5n"
+                " --parallel {snakemake.threads} -T {tmpdir}"
+                " | (if IFS= read -r first; then cat {header}; printf '%s\\n' \"$first\"; cat; else cat {header}; fi)"
+                " | bgzip --threads {snakemake.threads} > {annotation}"
+            )
+        elif out_gz:
+            download = "{source} > {annotation}"
+            if tee:
+                download = "{source} | tee {annotation} | gzip -d > {stream}"
+        else:
+            download = "{source} | gzip -d {tee} > {annotation}"
+
+        def fetch():
+            try:
+                shell("(" + download + ") {log}")
+            finally:
+                # Release the sidecar reader if the stream was never opened
+                if tee:
+                    try:
+                        os.close(os.open(stream, os.O_WRONLY | os.O_NONBLOCK))
+                    except OSError:
+                        pass
+
+        with ThreadPoolExecutor(2) as executor:
+            jobs = [executor.submit(fetch)]
+            if tee:
+                jobs.append(
+                    executor.submit(write_sidecars, stream, out_fmt, **sidecars)
+                )
+            for job in jobs:
+                job.result()
+
+    if index:
+        log = snakemake.log_fmt_shell(stdout=False, stderr=True, append=True)
+        csi = "--csi" if index.endswith(".csi") else ""
+        shell("tabix --preset gff {csi} --force {annotation} {log}")
+        default_index = annotation + (".csi" if csi else ".tbi")
+        if index != default_index:
+            shell("mv {default_index} {index}")
 except subprocess.CalledProcessError as e:
     if snakemake.log:
         sys.stderr = open(snakemake.log[0], "a")
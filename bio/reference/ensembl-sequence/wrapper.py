@@ -3,11 +3,114 @@ __copyright__ = "Copyright 2019, Johannes Köster"
 __email__ = "johannes.koester@uni-due.de"
 __license__ = "MIT"
 
+import fcntl
+import hashlib
+import os
 import subprocess as sp
 import sys
-from itertools import product
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from snakemake.shell import shell
 
+
+def exists(url):
+    """Check for a remote file by its header only"""
+    try:
+        shell("curl -sSfIL {url} > /dev/null 2> /dev/null")
+    except sp.CalledProcessError:
+        return False
+    return True
+
+
+def cached_download(url, dest, cache, max_size=None, log=""):
+    """
+    Download url to dest through a shared download cache
+
+    Entries are keyed by the URL and the validators of its headers (ETag,
+    Last-Modified, Content-Length). Every entry is fetched once under a
+    lock, moved in place when complete and hardlinked to dest (copied,
+    reflinked if possible, across filesystems). Beyond max_size bytes,
+    the least recently used entries are evicted along with their locks.
+    Returns the entry.
+    """
+
+    def lock(path, flags=fcntl.LOCK_EX):
+        # The lock file of an evicted entry may be removed while waiting
+        # for it, in which case the new one is locked instead
+        while True:
+            lock_file = open(path + ".lock", "a")
+            try:
+                fcntl.flock(lock_file, flags)
+            except BlockingIOError:
+                lock_file.close()
+                return None
+            try:
+                if os.path.samestat(
+                    os.fstat(lock_file.fileno()), os.stat(lock_file.name)
+                ):
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+
+    headers = {}
+    try:
+        for line in shell("curl -sSfIL {url} 2> /dev/null", iterable=True):
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+    except subprocess.CalledProcessError:
+        # Servers refusing HEAD requests are keyed by URL only
+        pass
+    validators = [
+        headers.get(h, "") for h in ("etag", "last-modified", "content-length")
+    ]
+    key = hashlib.sha256("\t".join([url, *validators]).encode()).hexdigest()
+
+    os.makedirs(cache, exist_ok=True)
+    entry = os.path.join(cache, key)
+    # Concurrent jobs wait for the first one to populate the entry
+    with lock(entry):
+        if not os.path.exists(entry):
+            partial = entry + ".part"
+            shell("curl -sSfL --continue-at - --output {partial} {url} {log}")
+            os.rename(partial, entry)
+        os.utime(entry)
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(entry, dest)
+        except OSError:
+            shell("cp --reflink=auto {entry} {dest}")
+
+    if max_size:
+        entries = []
+        for candidate in os.scandir(cache):
+            if len(candidate.name) == len(key):
+                try:
+                    stat = candidate.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, candidate.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= max_size:
+                break
+            if path == entry:
+                continue
+            # Entries being populated or linked are kept
+            evicted = lock(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if evicted is None:
+                continue
+            with evicted:
+                if os.path.exists(path):
+                    os.remove(path)
+                os.remove(path + ".lock")
+            total -= size
+    return entry
+
+
 species = snakemake.params.species.lower()
 release = int(snakemake.params.release)
 build = snakemake.params.build
@@ -19,8 +122,6 @@ if release >= 81 and build == "GRCh37":
 elif snakemake.params.get("branch"):
     branch = snakemake.params.branch + "/"
 
-log = snakemake.log_fmt_shell(stdout=False, stderr=True)
-
 spec = ("{build}" if int(release) > 75 else "{build}.{release}").format(
     build=build, release=release
 )
@@ -28,6 +129,8 @@ spec = ("{build}" if int(release) > 75 else "{build}.{release}").format(
 suffixes = ""
 datatype = snakemake.params.get("datatype", "")
 chromosome = snakemake.params.get("chromosome", "")
+if isinstance(chromosome, str):
+    chromosome = [chromosome] if chromosome else []
 if datatype == "dna":
     if chromosome:
         suffixes = [f"dna.chromosome.{chrom}.fa.gz" for chrom in chromosome]
@@ -51,20 +154,27 @@ if chromosome:
         )
 
 spec = spec.format(build=build, release=release)
-url_prefix = f"ftp://ftp.ensembl.org/pub/{branch}release-{release}/fasta/{species}/{datatype}/{species.capitalize()}.{spec}"
-
-success = False
-for suffix in suffixes:
-    url = f"{url_prefix}.{suffix}"
+base_url = snakemake.params.get("url", "ftp://ftp.ensembl.org/pub").rstrip("/")
+url_prefix = f"{base_url}/{branch}release-{release}/fasta/{species}/{datatype}/{species.capitalize()}.{spec}"
 
-    try:
-        shell("curl -sSf {url} > /dev/null 2> /dev/null")
-    except sp.CalledProcessError:
-        continue
-
-    shell("(curl -L {url} | gzip -d >> {snakemake.output[0]}) {log}")
-    success = True
-    break
+if chromosome:
+    # Every chromosome is needed
+    urls = [f"{url_prefix}.{suffix}" for suffix in suffixes]
+    with ThreadPoolExecutor(len(urls)) as executor:
+        success = all(executor.map(exists, urls))
+else:
+    # The first available alternative is taken
+    urls = [
+        next(
+            (
+                f"{url_prefix}.{suffix}"
+                for suffix in suffixes
+                if exists(f"{url_prefix}.{suffix}")
+            ),
+            None,
+        )
+    ]
+    success = urls[0] is not None
 
 if not success:
     if len(suffixes) > 1:
@@ -78,3 +188,86 @@ if not success:
         file=sys.stderr,
     )
     exit(1)
+
+
+fasta = snakemake.output[0]
+fai = snakemake.output.get("fai", "")
+gzi = snakemake.output.get("gzi", "")
+bgzip = fasta.endswith(".gz")
+if (fai or gzi) and not bgzip:
+    raise ValueError("fai and gzi outputs need a bgzip compressed output (*.gz)")
+
+if snakemake.log:
+    open(snakemake.log[0], "w").close()
+log = snakemake.log_fmt_shell(stdout=False, stderr=True, append=True)
+
+cache = snakemake.params.get(
+    "cache", os.environ.get("SNAKEMAKE_WRAPPERS_DOWNLOAD_CACHE", "")
+)
+cache_size = snakemake.params.get(
+    "cache_size", os.environ.get("SNAKEMAKE_WRAPPERS_DOWNLOAD_CACHE_SIZE", "")
+)
+max_size = float(cache_size) * 1024**3 if cache_size else None
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    if len(urls) == 1 and not cache:
+        download = f"curl -sSfL {urls[0]}"
+    else:
+        # Chromosomes are fetched side by side and their gzip members
+        # concatenated in the requested order
+        parts = [os.path.join(tmpdir, f"part.{i}.fa.gz") for i in range(len(urls))]
+
+        def fetch(url, part):
+            if cache:
+                cached_download(url, part, cache, max_size, log)
+            else:
+                shell("curl -sSfL {url} -o {part} {log}")
+
+        with ThreadPoolExecutor(len(urls)) as executor:
+            for job in [executor.submit(fetch, *args) for args in zip(urls, parts)]:
+                job.result()
+        download = "cat {}".format(" ".join(parts))
+
+    decompress = f"pigz -dc -p {snakemake.threads}"
+    if not bgzip:
+        shell("({download} | {decompress} > {fasta}) {log}")
+    elif not fai:
+        index = f"--index --index-name {gzi}" if gzi else ""
+        shell(
+            "({download} | {decompress}"
+            " | bgzip --threads {snakemake.threads} {index} > {fasta}) {log}"
+        )
+    else:
+        index = f"--index --index-name {gzi}" if gzi else ""
+        # The .fai is computed from the same decompressed stream
+        stream = os.path.join(tmpdir, "stream.fa")
+        os.mkfifo(stream)
+
+        def compress():
+            try:
+                shell(
+                    "({download} | {decompress}"
+                    " | tee --output-error=warn-nopipe {stream}"
+                    " | bgzip --threads {snakemake.threads} {index} > {fasta}) {log}"
+                )
+            finally:
+                # Release the indexer if the stream was never opened
+                try:
+                    os.close(os.open(stream, os.O_WRONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+
+        def faidx():
+            shell(
+                "awk '"
+                "function record() {{"
+                ' if (name != "") printf "%s\\t%.0f\\t%.0f\\t%d\\t%d\\n", name, bases, offset, width, (width ? width + 1 : 0)'
+                " }}"
+                " /^>/ {{ record(); name = substr($1, 2); bases = width = 0; pos += length($0) + 1; offset = pos; next }}"
+                " {{ if (!width) width = length($0); bases += length($0); pos += length($0) + 1 }}"
+                " END {{ record() }}' {stream} > {fai} {log}"
+            )
+
+        with ThreadPoolExecutor(2) as executor:
+            for job in [executor.submit(compress), executor.submit(faidx)]:
+                job.result()
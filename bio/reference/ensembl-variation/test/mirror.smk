@@ -0,0 +1,20 @@
+rule get_variation_from_mirror:
+    input:
+        fai="refs/genome.fasta.fai",
+    output:
+        vcf="refs/variation.mirror.vcf.gz",
+        index="refs/variation.mirror.vcf.gz.tbi",  # optional, defaults to a .csi next to the vcf
+    params:
+        species="saccharomyces_cerevisiae",
+        release="98",
+        build="R64-1-1",
+        type="all",  # one of "all", "somatic", "structural_variation"
+        url=f"file://{workflow.basedir}/mirror",  # optional, defaults to ftp://ftp.ensembl.org/pub
+        connections=2,  # optional, concurrent downloads, defaults to threads
+        cache="resources/download-cache",  # optional, shared download cache, defaults to $SNAKEMAKE_WRAPPERS_DOWNLOAD_CACHE
+        cache_size=1,  # optional, cap of the download cache in GB
+    log:
+        "logs/get_variation_from_mirror.log",
+    threads: 2
+    wrapper:
+        "master/bio/reference/ensembl-variation"
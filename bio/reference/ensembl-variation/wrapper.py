@@ -3,13 +3,147 @@ __copyright__ = "Copyright 2019, Johannes Köster"
 __email__ = "johannes.koester@uni-due.de"
 __license__ = "MIT"
 
-import tempfile
+import fcntl
+import hashlib
+import shutil
 import subprocess
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor
 from snakemake.shell import shell
 from snakemake.exceptions import WorkflowError
 
+
+def read_checksums(url):
+    """Read the `sum` checksums and block counts of a CHECKSUMS file by name"""
+    checksums = {}
+    try:
+        lines = list(shell("curl -sSfL {url}", iterable=True))
+    except subprocess.CalledProcessError:
+        return None
+    for line in lines:
+        fields = line.split()
+        if len(fields) == 3:
+            checksums[fields[2]] = (int(fields[0]), int(fields[1]))
+    return checksums
+
+
+def cached_download(url, dest, cache, max_size=None, log=""):
+    """
+    Download url to dest through a shared download cache
+
+    Entries are keyed by the URL and the validators of its headers (ETag,
+    Last-Modified, Content-Length). Every entry is fetched once under a
+    lock, moved in place when complete and hardlinked to dest (copied,
+    reflinked if possible, across filesystems). Beyond max_size bytes,
+    the least recently used entries are evicted along with their locks.
+    Returns the entry.
+    """
+
+    def lock(path, flags=fcntl.LOCK_EX):
+        # The lock file of an evicted entry may be removed while waiting
+        # for it, in which case the new one is locked instead
+        while True:
+            lock_file = open(path + ".lock", "a")
+            try:
+                fcntl.flock(lock_file, flags)
+            except BlockingIOError:
+                lock_file.close()
+                return None
+            try:
+                if os.path.samestat(
+                    os.fstat(lock_file.fileno()), os.stat(lock_file.name)
+                ):
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+
+    headers = {}
+    try:
+        for line in shell("curl -sSfIL {url} 2> /dev/null", iterable=True):
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+    except subprocess.CalledProcessError:
+        # Servers refusing HEAD requests are keyed by URL only
+        pass
+    validators = [
+        headers.get(h, "") for h in ("etag", "last-modified", "content-length")
+    ]
+    key = hashlib.sha256("\t".join([url, *validators]).encode()).hexdigest()
+
+    os.makedirs(cache, exist_ok=True)
+    entry = os.path.join(cache, key)
+    # Concurrent jobs wait for the first one to populate the entry
+    with lock(entry):
+        if not os.path.exists(entry):
+            partial = entry + ".part"
+            shell("curl -sSfL --continue-at - --output {partial} {url} {log}")
+            os.rename(partial, entry)
+        os.utime(entry)
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(entry, dest)
+        except OSError:
+            shell("cp --reflink=auto {entry} {dest}")
+
+    if max_size:
+        entries = []
+        for candidate in os.scandir(cache):
+            if len(candidate.name) == len(key):
+                try:
+                    stat = candidate.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, candidate.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= max_size:
+                break
+            if path == entry:
+                continue
+            # Entries being populated or linked are kept
+            evicted = lock(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if evicted is None:
+                continue
+            with evicted:
+                if os.path.exists(path):
+                    os.remove(path)
+                os.remove(path + ".lock")
+            total -= size
+    return entry
+
+
+def download(url, dest, checksum, retries):
+    """Download url to dest, resuming a partial download and verifying its checksum"""
+    if os.path.exists(dest):
+        return
+    partial = dest + ".part"
+    entry = None
+    for attempt in range(retries + 1):
+        try:
+            if cache:
+                entry = cached_download(url, partial, cache, max_size, log)
+            else:
+                shell("curl -sSfL --continue-at - --output {partial} {url} {log}")
+            break
+        except subprocess.CalledProcessError:
+            if attempt == retries:
+                raise
+    if checksum is not None:
+        fields = next(shell("sum {partial}", iterable=True)).split()
+        if (int(fields[0]), int(fields[1])) != checksum:
+            # A corrupt partial download cannot be resumed
+            os.remove(partial)
+            if entry and os.path.exists(entry):
+                os.remove(entry)
+            raise WorkflowError(f"Checksum mismatch for {url}")
+    os.rename(partial, dest)
+
+
 species = snakemake.params.species.lower()
 release = int(snakemake.params.release)
 build = snakemake.params.build
@@ -62,35 +196,64 @@ else:
 
 species_filename = species if release >= 91 else species.capitalize()
 
-urls = [
-    "ftp://ftp.ensembl.org/pub/{branch}release-{release}/variation/vcf/{species}/{species_filename}{suffix}.vcf.gz".format(
-        release=release,
-        species=species,
-        suffix=suffix,
-        species_filename=species_filename,
-        branch=branch,
-    )
-    for suffix in suffixes
-]
-names = [os.path.basename(url) for url in urls]
+base_url = snakemake.params.get("url", "ftp://ftp.ensembl.org/pub").rstrip("/")
+url_prefix = f"{base_url}/{branch}release-{release}/variation/vcf/{species}"
+urls = [f"{url_prefix}/{species_filename}{suffix}.vcf.gz" for suffix in suffixes]
+
+vcf = snakemake.output.get("vcf", snakemake.output[0])
+index = snakemake.output.get("index", "")
+index_ext = "tbi" if index.endswith(".tbi") else "csi"
+connections = snakemake.params.get("connections", snakemake.threads)
+retries = snakemake.params.get("retries", 3)
+
+cache = snakemake.params.get(
+    "cache", os.environ.get("SNAKEMAKE_WRAPPERS_DOWNLOAD_CACHE", "")
+)
+cache_size = snakemake.params.get(
+    "cache_size", os.environ.get("SNAKEMAKE_WRAPPERS_DOWNLOAD_CACHE_SIZE", "")
+)
+max_size = float(cache_size) * 1024**3 if cache_size else None
+
+# Downloads are kept until the output is written, so that a restarted job
+# only fetches the missing files and resumes the partial one
+download_dir = vcf + ".download"
+os.makedirs(download_dir, exist_ok=True)
+names = [os.path.join(download_dir, os.path.basename(url)) for url in urls]
+
+if snakemake.log:
+    open(snakemake.log[0], "w").close()
+log = snakemake.log_fmt_shell(stdout=False, stderr=True, append=True)
 
 try:
-    gather = "curl {urls}".format(urls=" ".join(map("-O {}".format, urls)))
-    workdir = os.getcwd()
-    with tempfile.TemporaryDirectory() as tmpdir:
-        if snakemake.input.get("fai"):
-            shell(
-                "(cd {tmpdir}; {gather} && "
-                "bcftools concat -Oz --naive {names} > concat.vcf.gz && "
-                "bcftools reheader --fai {workdir}/{snakemake.input.fai} concat.vcf.gz "
-                "> {workdir}/{snakemake.output}) {log}"
-            )
+    checksums = read_checksums(f"{url_prefix}/CHECKSUMS")
+    if checksums is None:
+        msg = f"No CHECKSUMS found at {url_prefix}, downloads are not verified."
+        if snakemake.log:
+            with open(snakemake.log[0], "a") as log_file:
+                print(msg, file=log_file)
         else:
-            shell(
-                "(cd {tmpdir}; {gather} && "
-                "bcftools concat -Oz --naive {names} "
-                "> {workdir}/{snakemake.output}) {log}"
-            )
+            print(msg, file=sys.stderr)
+    else:
+        checksums = [checksums.get(os.path.basename(url)) for url in urls]
+
+    with ThreadPoolExecutor(connections) as executor:
+        for job in [
+            executor.submit(download, url, name, checksum=checksum, retries=retries)
+            for url, name, checksum in zip(urls, names, checksums or [None] * len(urls))
+        ]:
+            job.result()
+
+    reheader = (
+        f"| bcftools reheader --fai {snakemake.input.fai} -"
+        if snakemake.input.get("fai")
+        else ""
+    )
+    shell("(bcftools concat -Oz --naive {names} {reheader} > {vcf}) {log}")
+    if index:
+        shell("bcftools index --{index_ext} {vcf} {log}")
+        if index != f"{vcf}.{index_ext}":
+            shell("mv {vcf}.{index_ext} {index}")
+    shutil.rmtree(download_dir)
 except subprocess.CalledProcessError as e:
     if snakemake.log:
         sys.stderr = open(snakemake.log[0], "a")
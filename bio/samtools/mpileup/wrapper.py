@@ -6,8 +6,29 @@ __email__ = "julianderuiter@gmail.com"
 __license__ = "MIT"
 
 
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 from snakemake.shell import shell
 
+
+def contig_groups(fai, groups):
+    """Split the contigs of a .fai in consecutive groups of balanced length"""
+    with open(fai) as fai_file:
+        contigs = [line.split("\t")[:2] for line in fai_file]
+    total = sum(int(length) for _, length in contigs)
+
+    splits = [[]]
+    seen = 0
+    for contig, length in contigs:
+        if splits[-1] and len(splits) < groups and seen >= total * len(splits) / groups:
+            splits.append([])
+        splits[-1].append(contig)
+        seen += int(length)
+    return splits
+
+
 extra = snakemake.params.get("extra", "")
 log = snakemake.log_fmt_shell(stdout=False, stderr=True)
 
@@ -16,6 +37,57 @@ if not snakemake.output[0].endswith(".gz"):
         'output file will be compressed and therefore filename should end with ".gz"'
     )
 
-shell(
-    "(samtools mpileup {extra} -f {snakemake.input.reference_genome} {snakemake.input.bam} | pigz > {snakemake.output}) {log}"
-)
+ref = snakemake.input.reference_genome
+bam = snakemake.input.bam
+if not isinstance(bam, str):
+    bam = " ".join(bam)
+out = snakemake.output[0]
+idx = snakemake.output.get("idx", "")
+
+# Every group runs one (single-threaded) mpileup, the remaining threads compress
+groups = snakemake.threads // 2
+if "-r" in extra.split() or "--region" in extra:
+    groups = 1
+
+if groups <= 1:
+    shell(
+        "(samtools mpileup {extra} -f {ref} {bam}"
+        " | bgzip --threads {snakemake.threads} > {out}) {log}"
+    )
+else:
+    fai = snakemake.input.get("fai", ref + ".fai")
+    contigs = contig_groups(fai, groups)
+    compress_threads = max(1, (snakemake.threads - len(contigs)) // len(contigs))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        parts = [os.path.join(tmpdir, f"part.{i}.gz") for i in range(len(contigs))]
+        logs = [os.path.join(tmpdir, f"part.{i}.log") for i in range(len(contigs))]
+
+        def pileup(group, part, part_log):
+            regions = "; ".join(
+                f"samtools mpileup {extra} -f {ref} -r {contig} {bam}"
+                for contig in group
+            )
+            shell(
+                "(({regions}) | bgzip --threads {compress_threads} > {part})"
+                " 2> {part_log}"
+            )
+
+        try:
+            with ThreadPoolExecutor(len(contigs)) as executor:
+                for job in [
+                    executor.submit(pileup, *args) for args in zip(contigs, parts, logs)
+                ]:
+                    job.result()
+        finally:
+            if snakemake.log:
+                shell("cat {logs} > {snakemake.log}")
+
+        # BGZF files can be concatenated as they are
+        shell("cat {parts} > {out}")
+
+if idx:
+    log = snakemake.log_fmt_shell(stdout=False, stderr=True, append=True)
+    shell("tabix --sequence 1 --begin 2 --end 2 {out} {log}")
+    if idx != out + ".tbi":
+        shell("mv {out}.tbi {idx}")
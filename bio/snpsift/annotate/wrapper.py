@@ -5,15 +5,31 @@ __copyright__ = "Copyright 2020, Dayris Thibault"
 __email__ = "thibault.dayris@gustaveroussy.fr"
 __license__ = "MIT"
 
+import hashlib
+import os
+import tempfile
+
 from snakemake.shell import shell
 from snakemake_wrapper_utils.java import get_java_opts
 
 java_opts = get_java_opts(snakemake)
 
 log = snakemake.log_fmt_shell(stdout=False, stderr=True)
+log_append = snakemake.log_fmt_shell(stdout=False, stderr=True, append=True)
 extra = snakemake.params.get("extra", "")
 min_threads = 1
 
+# Restrict the database to the regions covered by the calls (or by a
+# user-provided BED), so SnpSift does not have to scan the whole database
+database = snakemake.input["database"]
+regions = snakemake.input.get("regions", "")
+subset = snakemake.params.get("subset", False) or regions != ""
+subset_cache = snakemake.params.get("subset_cache", "")
+if subset and not database.endswith("gz"):
+    raise ValueError(
+        "Region subsetting requires a bgzipped and tabix-indexed annotation file"
+    )
+
 incall = snakemake.input["call"]
 if snakemake.input["call"].endswith("bcf"):
     min_threads += 1
@@ -39,11 +55,58 @@ if snakemake.threads < min_threads:
         )
     )
 
-shell(
-    "SnpSift annotate"  # Tool and its subcommand
-    " {java_opts} {extra}"  # Extra parameters
-    " {snakemake.input.database}"  # Path to annotation vcf file
-    " {incall} "  # Path to input vcf file
-    " {outcall} "  # Path to output vcf file
-    " {log}"  # Logging behaviour
-)
+with tempfile.TemporaryDirectory() as tmpdir:
+    if subset:
+        bed = os.path.join(tmpdir, "regions.bed")
+        if regions == "":
+            regions = "<(bcftools query -f '%CHROM\\t%POS0\\t%END\\n' {})".format(
+                snakemake.input["call"]
+            )
+        shell(
+            "(sort -k1,1 -k2,2n {regions} | bedtools merge -i stdin > {bed})" " {log}"
+        )
+
+        # Subsets are keyed by the merged target regions and the database
+        # they were extracted from, hence reusable across runs
+        with open(bed, "rb") as bed_stream:
+            key = hashlib.sha256(bed_stream.read())
+        db_stat = os.stat(database)
+        key.update(
+            "{}:{}:{}".format(
+                os.path.abspath(database), db_stat.st_size, db_stat.st_mtime
+            ).encode()
+        )
+        subset_dir = subset_cache or tmpdir
+        os.makedirs(subset_dir, exist_ok=True)
+        subset_db = os.path.join(
+            subset_dir,
+            "{}.{}.vcf.gz".format(
+                os.path.basename(database).split(".")[0], key.hexdigest()[:16]
+            ),
+        )
+
+        if not (os.path.exists(subset_db) and os.path.exists(subset_db + ".tbi")):
+            # Build next to the final location, then rename, so concurrent
+            # jobs sharing a cache never see a partial subset
+            fd, partial = tempfile.mkstemp(dir=subset_dir, suffix=".vcf.gz")
+            os.close(fd)
+            shell(
+                "(tabix --print-header --regions {bed} {database}"
+                " | bgzip --stdout > {partial}"
+                " && tabix --preset vcf {partial})"
+                " {log_append}"
+            )
+            os.replace(partial + ".tbi", subset_db + ".tbi")
+            os.replace(partial, subset_db)
+        database = subset_db
+
+        log = log_append
+
+    shell(
+        "SnpSift annotate"  # Tool and its subcommand
+        " {java_opts} {extra}"  # Extra parameters
+        " {database}"  # Path to annotation vcf file
+        " {incall} "  # Path to input vcf file
+        " {outcall} "  # Path to output vcf file
+        " {log}"  # Logging behaviour
+    )
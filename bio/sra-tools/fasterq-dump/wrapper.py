@@ -4,11 +4,12 @@ __email__ = "johannes.koester@uni-due.de"
 __license__ = "MIT"
 
 import os
+import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from snakemake.shell import shell
 from snakemake_wrapper_utils.snakemake import get_mem
 
-
 log = snakemake.log_fmt_shell(stdout=True, stderr=True)
 extra = snakemake.params.get("extra", "")
 
@@ -17,30 +18,46 @@ extra = snakemake.params.get("extra", "")
 mem_mb = get_mem(snakemake, "MiB")
 
 
-# Outdir
-outdir = os.path.dirname(snakemake.output[0])
-if outdir:
-    outdir = f"--outdir {outdir}"
-
-
 # Output compression
-compress = ""
-mem = f"-m{mem_mb}" if mem_mb else ""
-
-for output in snakemake.output:
-    out_name, out_ext = os.path.splitext(output)
-    if out_ext == ".gz":
-        compress += f"pigz -p {snakemake.threads} {out_name}; "
-    elif out_ext == ".bz2":
-        compress += f"pbzip2 -p{snakemake.threads} {mem} {out_name}; "
+compressors = {
+    ".gz": "pigz -c -p {threads} {src}",
+    ".bz2": "pbzip2 -c -p{threads} {mem} {src}",
+    ".zst": "zstd -c -q -T{threads} {src}",
+}
+compressed = [
+    output for output in snakemake.output if os.path.splitext(output)[1] in compressors
+]
+# Mates are compressed side by side, sharing the threads and memory
+compress_threads = max(1, snakemake.threads // max(1, len(compressed)))
+compress_mem = f"-m{mem_mb // len(compressed)}" if mem_mb and compressed else ""
 
 
 with tempfile.TemporaryDirectory() as tmpdir:
+    # Uncompressed reads only live in the temporary directory
+    outdir = os.path.join(tmpdir, "out")
     mem = f"--mem {mem_mb}M" if mem_mb else ""
 
     shell(
         "(fasterq-dump --temp {tmpdir} --threads {snakemake.threads} {mem} "
-        "{extra} {outdir} {snakemake.wildcards.accession}; "
-        "{compress}"
+        "{extra} --outdir {outdir} {snakemake.wildcards.accession}"
         ") {log}"
     )
+
+    compress_log = snakemake.log_fmt_shell(stdout=False, stderr=True, append=True)
+
+    def compress(output):
+        out_name, out_ext = os.path.splitext(output)
+        src = os.path.join(outdir, os.path.basename(out_name))
+        compressor = compressors[out_ext].format(
+            threads=compress_threads, mem=compress_mem, src=src
+        )
+        shell("{compressor} > {output} {compress_log}")
+        os.remove(src)
+
+    with ThreadPoolExecutor(max(1, len(compressed))) as executor:
+        jobs = [executor.submit(compress, output) for output in compressed]
+        for output in snakemake.output:
+            if output not in compressed:
+                shutil.move(os.path.join(outdir, os.path.basename(output)), output)
+        for job in jobs:
+            job.result()
@@ -5,9 +5,56 @@ __copyright__ = "Copyright 2021, Patrik Smeds"
 __email__ = "patrik.smeds@scilifelab.uu.se"
 __license__ = "MIT"
 
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from snakemake.shell import shell
 
+
+def bed_column(bed_columns, option, default):
+    """1-based BED column given to a vardict option (e.g. `-S 2`)"""
+    args = bed_columns.split()
+    if option in args[:-1]:
+        return int(args[args.index(option) + 1])
+    return default
+
+
+def split_regions(regions, chunks, bed_columns, tmpdir):
+    """
+    Split the regions in at most `chunks` files of balanced total length
+
+    Regions are assigned longest first to the least loaded chunk, and keep
+    their original order within each chunk.
+    """
+    start = bed_column(bed_columns, "-S", 2) - 1
+    end = bed_column(bed_columns, "-E", 3) - 1
+    with open(regions) as bed:
+        lines = [
+            line
+            for line in bed
+            if line.strip() and not line.startswith(("#", "track", "browser"))
+        ]
+
+    loads = [0] * min(chunks, len(lines))
+    assigned = [[] for _ in loads]
+    lengths = [
+        int(line.split("\t")[end]) - int(line.split("\t")[start]) for line in lines
+    ]
+    for i in sorted(range(len(lines)), key=lambda i: -lengths[i]):
+        chunk = loads.index(min(loads))
+        loads[chunk] += lengths[i]
+        assigned[chunk].append(i)
+
+    paths = []
+    for i, chunk in enumerate(assigned):
+        path = os.path.join(tmpdir, "chunk.{}.bed".format(i))
+        with open(path, "w") as bed:
+            bed.writelines(lines[j] for j in sorted(chunk))
+        paths.append(path)
+    return paths
+
+
 log = snakemake.log_fmt_shell(stdout=False, stderr=True)
 
 reference = snakemake.input.reference
@@ -19,6 +66,8 @@ vcf = snakemake.output.vcf
 extra = snakemake.params.get("extra", "")
 bed_columns = snakemake.params.get("bed_columns", "-c 1 -S 2 -E 3 -g 4")
 af_th = snakemake.params.get("allele_frequency_threshold", "0.01")
+# Every chunk runs its own JVM, at least one thread each
+chunks = min(snakemake.params.get("chunks", 1), snakemake.threads)
 
 
 if normal is None:
@@ -33,16 +82,61 @@ else:
     post_scripts = 'testsomatic.R | var2vcf_paired.pl -N "' + name + '" -f ' + af_th
 
 
-shell(
-    "vardict-java -G {reference} "
-    "-f {af_th} "
-    " {extra} "
-    "-th {snakemake.threads} "
-    "{bed_columns} "
-    "-N '{name}' "
-    "-b {input_bams} "
-    "{regions} |"
-    "{post_scripts} "
-    "> {vcf}"
-    "{log}"
-)
+if chunks <= 1:
+    shell(
+        "vardict-java -G {reference} "
+        "-f {af_th} "
+        " {extra} "
+        "-th {snakemake.threads} "
+        "{bed_columns} "
+        "-N '{name}' "
+        "-b {input_bams} "
+        "{regions} |"
+        "{post_scripts} "
+        "> {vcf}"
+        "{log}"
+    )
+else:
+    # Each chunk runs its own vardict and R/Perl post-processing pipeline,
+    # so the single-threaded post-processing no longer caps throughput
+    with tempfile.TemporaryDirectory() as tmpdir:
+        beds = split_regions(regions, chunks, bed_columns, tmpdir)
+        vcfs = [bed[: -len(".bed")] + ".vcf" for bed in beds]
+        logs = [bed[: -len(".bed")] + ".log" for bed in beds]
+        threads = max(1, snakemake.threads // len(beds))
+
+        def call(chunk_regions, chunk_vcf, chunk_log):
+            shell(
+                "(vardict-java -G {reference} "
+                "-f {af_th} "
+                " {extra} "
+                "-th {threads} "
+                "{bed_columns} "
+                "-N '{name}' "
+                "-b {input_bams} "
+                "{chunk_regions} |"
+                "{post_scripts} "
+                "> {chunk_vcf}) "
+                "2> {chunk_log}"
+            )
+
+        try:
+            with ThreadPoolExecutor(len(beds)) as executor:
+                for job in [
+                    executor.submit(call, *args) for args in zip(beds, vcfs, logs)
+                ]:
+                    job.result()
+        finally:
+            if snakemake.log:
+                shell("cat {logs} > {snakemake.log}")
+
+        # Records are merged in the contig order of the reference index,
+        # then by position
+        shell(
+            "(grep '^#' {vcfs[0]};"
+            " awk 'NR == FNR {{rank[$1] = NR; next}} !/^#/ {{print rank[$1] \"\\t\" $0}}'"
+            " {reference}.fai {vcfs}"
+            " | sort -T {tmpdir} -k1,1n -k3,3n"
+            " | cut -f 2-"
+            ") > {vcf}"
+        )
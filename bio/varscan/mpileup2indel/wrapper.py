@@ -6,33 +6,136 @@ __email__ = "thibault.dayris@gustaveroussy.fr"
 __license__ = "MIT"
 
 import os.path as op
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 from snakemake.shell import shell
 from snakemake.utils import makedirs
 from snakemake_wrapper_utils.java import get_java_opts
 
+
+def contig_groups(fai, groups):
+    """Split the contigs of a .fai in consecutive groups of balanced length"""
+    with open(fai) as fai_file:
+        contigs = [line.split("\t")[:2] for line in fai_file]
+    total = sum(int(length) for _, length in contigs)
+
+    splits = [[]]
+    seen = 0
+    for contig, length in contigs:
+        if splits[-1] and len(splits) < groups and seen >= total * len(splits) / groups:
+            splits.append([])
+        splits[-1].append(contig)
+        seen += int(length)
+    return splits
+
+
+def merge_outputs(parts, output):
+    """Concatenate part outputs in order, keeping the header of the first one"""
+    with open(output, "w") as out:
+        for i, part in enumerate(parts):
+            with open(part) as part_file:
+                out.writelines(
+                    line
+                    for line in part_file
+                    if i == 0 or not line.lower().startswith(("#", "chrom\t"))
+                )
+
+
+def tabix_indexed(pileup):
+    return op.exists(pileup + ".tbi") or op.exists(pileup + ".csi")
+
+
 # Gathering extra parameters and logging behaviour
 log = snakemake.log_fmt_shell(stdout=False, stderr=True)
 extra = snakemake.params.get("extra", "")
+mpileup_extra = snakemake.params.get("mpileup", "")
 java_opts = get_java_opts(snakemake)
 
-# In case input files are gzipped mpileup files,
-# they are being unzipped and piped
-# In that case, it is recommended to use at least 2 threads:
-# - One for unzipping with zcat
-# - One for running varscan
-pileup = (
-    " cat {} ".format(snakemake.input[0])
-    if not snakemake.input[0].endswith("gz")
-    else " zcat {} ".format(snakemake.input[0])
-)
-
 # Building output directories
 makedirs(op.dirname(snakemake.output[0]))
 
-shell(
-    "varscan mpileup2indel "  # Tool and its subprocess
-    "<( {pileup} ) "
-    "{java_opts} {extra} "  # Extra parameters
-    "> {snakemake.output[0]} "  # Path to vcf file
-    "{log}"  # Logging behaviour
-)
+bam = snakemake.input.get("bam", "")
+if bam:
+    # The pileup is generated on the fly from the alignments,
+    # one `samtools mpileup | varscan` pipeline per group of contigs
+    ref = snakemake.input.ref
+    fai = snakemake.input.get("fai", ref + ".fai")
+
+    def pileup_regions(contigs):
+        return "; ".join(
+            "samtools mpileup {} -f {} -r {} {}".format(mpileup_extra, ref, contig, bam)
+            for contig in contigs
+        )
+
+else:
+    # In case input files are gzipped mpileup files,
+    # they are being unzipped and piped
+    # In that case, it is recommended to use at least 2 threads:
+    # - One for unzipping with zcat
+    # - One for running varscan
+    in_pileup = snakemake.input.get("mpileup", snakemake.input[0])
+    fai = snakemake.input.get("fai", "")
+
+    def pileup_regions(contigs):
+        # bgzipped and tabix-indexed pileups can be queried per contig
+        return "tabix {} {}".format(in_pileup, " ".join(contigs))
+
+
+# Each pipeline runs a pileup producer and varscan. Calling is only split
+# when the contigs are known and the pileup can be queried by contig.
+groups = snakemake.threads // 2
+if not op.exists(fai) or not (bam or tabix_indexed(in_pileup)):
+    groups = 1
+
+if groups <= 1:
+    if bam:
+        pileup = "samtools mpileup {} -f {} {}".format(mpileup_extra, ref, bam)
+    else:
+        pileup = (
+            " cat {} ".format(in_pileup)
+            if not in_pileup.endswith("gz")
+            else " zcat {} ".format(in_pileup)
+        )
+    shell(
+        "varscan mpileup2indel "  # Tool and its subprocess
+        "<( {pileup} ) "
+        "{java_opts} {extra} "  # Extra parameters
+        "> {snakemake.output[0]} "  # Path to vcf file
+        "{log}"  # Logging behaviour
+    )
+else:
+    contigs = contig_groups(fai, groups)
+    # Each JVM gets its share of the reserved memory
+    java_opts = re.sub(
+        r"-Xmx(\d+)M",
+        lambda xmx: "-Xmx{}M".format(int(xmx.group(1)) // len(contigs)),
+        java_opts,
+    )
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        parts = [op.join(tmpdir, "part.{}.out".format(i)) for i in range(len(contigs))]
+        logs = [op.join(tmpdir, "part.{}.log".format(i)) for i in range(len(contigs))]
+
+        def call(group, part, part_log):
+            pileup = pileup_regions(group)
+            shell(
+                "varscan mpileup2indel "
+                "<( {pileup} ) "
+                "{java_opts} {extra} "
+                "> {part} "
+                "2> {part_log}"
+            )
+
+        try:
+            with ThreadPoolExecutor(len(contigs)) as executor:
+                for job in [
+                    executor.submit(call, *args) for args in zip(contigs, parts, logs)
+                ]:
+                    job.result()
+        finally:
+            if snakemake.log:
+                shell("cat {logs} > {snakemake.log}")
+
+        merge_outputs(parts, snakemake.output[0])
@@ -7,14 +7,58 @@ __license__ = "MIT"
 
 
 import os.path as op
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 from snakemake.shell import shell
 from snakemake.utils import makedirs
 from snakemake_wrapper_utils.java import get_java_opts
 
+
+def contig_groups(fai, groups):
+    """Split the contigs of a .fai in consecutive groups of balanced length"""
+    with open(fai) as fai_file:
+        contigs = [line.split("\t")[:2] for line in fai_file]
+    total = sum(int(length) for _, length in contigs)
+
+    splits = [[]]
+    seen = 0
+    for contig, length in contigs:
+        if splits[-1] and len(splits) < groups and seen >= total * len(splits) / groups:
+            splits.append([])
+        splits[-1].append(contig)
+        seen += int(length)
+    return splits
+
+
+def merge_outputs(parts, output):
+    """Concatenate part outputs in order, keeping the header of the first one"""
+    with open(output, "w") as out:
+        for i, part in enumerate(parts):
+            with open(part) as part_file:
+                out.writelines(
+                    line
+                    for line in part_file
+                    if i == 0 or not line.lower().startswith(("#", "chrom\t"))
+                )
+
+
+def tabix_indexed(pileup):
+    return op.exists(pileup + ".tbi") or op.exists(pileup + ".csi")
+
+
+def plain_text(pileup):
+    """Varscan only reads plain text pileups, decompress gzipped ones"""
+    if pileup.endswith("gz"):
+        return "<(bgzip -dc {})".format(pileup)
+    return pileup
+
+
 # Defining logging and gathering extra parameters
 log = snakemake.log_fmt_shell(stdout=True, stderr=True)
 extra = snakemake.params.get("extra", "")
+mpileup_extra = snakemake.params.get("mpileup", "")
 java_opts = get_java_opts(snakemake)
 
 # Building output dirs
@@ -26,25 +70,114 @@ prefix = op.splitext(snakemake.output.snp)[0]
 
 # Searching for input files
 pileup_pair = ["normal_pileup", "tumor_pileup"]
+bam_pair = ["normal_bam", "tumor_bam"]
 
 in_pileup = ""
 mpileup = ""
-if "mpileup" in snakemake.input.keys():
+fai = snakemake.input.get("fai", "")
+if all(bam in snakemake.input.keys() for bam in bam_pair):
+    # Case the mpileup is generated on the fly from normal and tumor
+    # alignments, one `samtools mpileup | varscan` pipeline per group of contigs
+    mpileup = "--mpileup 1"
+    ref = snakemake.input.ref
+    fai = fai or ref + ".fai"
+    bams = "{} {}".format(snakemake.input.normal_bam, snakemake.input.tumor_bam)
+    in_pileup = "<(samtools mpileup {} -f {} {})".format(mpileup_extra, ref, bams)
+    queryable = True
+
+    def pileup_regions(contigs):
+        return "<({})".format(
+            "; ".join(
+                "samtools mpileup {} -f {} -r {} {}".format(
+                    mpileup_extra, ref, contig, bams
+                )
+                for contig in contigs
+            )
+        )
+
+elif "mpileup" in snakemake.input.keys():
     # Case there is a mpileup with both normal and tumor
-    in_pileup = snakemake.input.mpileup
+    in_pileup = plain_text(snakemake.input.mpileup)
     mpileup = "--mpileup 1"
+    queryable = tabix_indexed(snakemake.input.mpileup)
+
+    def pileup_regions(contigs):
+        # bgzipped and tabix-indexed mpileups can be queried per contig
+        return "<(tabix {} {})".format(snakemake.input.mpileup, " ".join(contigs))
+
 elif all(pileup in snakemake.input.keys() for pileup in pileup_pair):
     # Case there are two separate pileup files
-    in_pileup = " {snakemake.input.normal_pileup}" " {snakemakeinput.tumor_pileup} "
+    in_pileup = "{} {}".format(
+        plain_text(snakemake.input.normal_pileup),
+        plain_text(snakemake.input.tumor_pileup),
+    )
+    queryable = all(tabix_indexed(snakemake.input[pileup]) for pileup in pileup_pair)
+
+    def pileup_regions(contigs):
+        return " ".join(
+            "<(tabix {} {})".format(pileup, " ".join(contigs))
+            for pileup in (snakemake.input.normal_pileup, snakemake.input.tumor_pileup)
+        )
+
+else:
+    raise KeyError(
+        "Could not find either a pair of bam files, a mpileup, "
+        "or a pair of pileup files"
+    )
+
+# Each pipeline runs its pileup producer(s) and varscan. Calling is only
+# split when the contigs are known and the pileups can be queried by contig.
+groups = snakemake.threads // 2
+if not op.exists(fai) or not queryable:
+    groups = 1
+
+if groups <= 1:
+    shell(
+        "varscan somatic"  # Tool and its subcommand
+        " {in_pileup}"  # Path to input file(s)
+        " {prefix}"  # Path to output
+        " {java_opts} {extra}"  # Extra parameters
+        " {mpileup}"
+        " --output-snp {snakemake.output.snp}"  # Path to snp output file
+        " --output-indel {snakemake.output.indel}"  # Path to indel output file
+        " {log}"  # Logging behaviour
+    )
 else:
-    raise KeyError("Could not find either a mpileup, or a pair of pileup files")
-
-shell(
-    "varscan somatic"  # Tool and its subcommand
-    " {in_pileup}"  # Path to input file(s)
-    " {prefix}"  # Path to output
-    " {java_opts} {extra}"  # Extra parameters
-    " {mpileup}"
-    " --output-snp {snakemake.output.snp}"  # Path to snp output file
-    " --output-indel {snakemake.output.indel}"  # Path to indel output file
-)
+    contigs = contig_groups(fai, groups)
+    # Each JVM gets its share of the reserved memory
+    java_opts = re.sub(
+        r"-Xmx(\d+)M",
+        lambda xmx: "-Xmx{}M".format(int(xmx.group(1)) // len(contigs)),
+        java_opts,
+    )
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        prefixes = [op.join(tmpdir, "part.{}".format(i)) for i in range(len(contigs))]
+        logs = [part + ".log" for part in prefixes]
+
+        def call(group, part, part_log):
+            in_pileup = pileup_regions(group)
+            shell(
+                "varscan somatic"
+                " {in_pileup}"
+                " {part}"
+                " {java_opts} {extra}"
+                " {mpileup}"
+                " --output-snp {part}.snp"
+                " --output-indel {part}.indel"
+                " > {part_log} 2>&1"
+            )
+
+        try:
+            with ThreadPoolExecutor(len(contigs)) as executor:
+                for job in [
+                    executor.submit(call, *args)
+                    for args in zip(contigs, prefixes, logs)
+                ]:
+                    job.result()
+        finally:
+            if snakemake.log:
+                shell("cat {logs} > {snakemake.log}")
+
+        merge_outputs([part + ".snp" for part in prefixes], snakemake.output.snp)
+        merge_outputs([part + ".indel" for part in prefixes], snakemake.output.indel)
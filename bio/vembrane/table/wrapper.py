@@ -5,17 +5,102 @@ __copyright__ = "Copyright 2020, Christopher Schröder"
 __email__ = "christopher.schroeder@tu-dortmund.de"
 __license__ = "MIT"
 
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 from snakemake.shell import shell
 
+
+def contig_shards(vcf, shards, tmpdir):
+    """
+    Split an indexed input into at most `shards` consecutive groups of
+    contigs, balanced by record count
+
+    Returns the commands streaming each group, or none for inputs without
+    index or with records on a single contig, which are processed whole.
+    """
+    index = snakemake.input.get("index", "") or next(
+        (vcf + ext for ext in (".tbi", ".csi") if os.path.exists(vcf + ext)), ""
+    )
+    if shards <= 1 or not index:
+        return []
+
+    # Indexes elsewhere than next to the input are given to bcftools explicitly
+    source = vcf if index in (vcf + ".tbi", vcf + ".csi") else f"{vcf}##idx##{index}"
+    contigs = []
+    for line in shell("bcftools index --stats {source}", iterable=True):
+        contig, length, records = line.split("\t")
+        if int(records):
+            length = length if length != "." else "2147483647"
+            contigs.append((contig, length, int(records)))
+    if len(contigs) < 2:
+        return []
+
+    total = sum(records for _, _, records in contigs)
+    groups = [[contigs[0]]]
+    seen = contigs[0][2]
+    for contig in contigs[1:]:
+        if len(groups) < shards and seen >= total * len(groups) / shards:
+            groups.append([])
+        groups[-1].append(contig)
+        seen += contig[2]
+
+    commands = []
+    for i, group in enumerate(groups):
+        regions = os.path.join(tmpdir, f"shard.{i}.regions.tsv")
+        with open(regions, "w") as regions_file:
+            for contig, length, _ in group:
+                print(contig, 1, length, sep="\t", file=regions_file)
+        commands.append(
+            f"bcftools view --output-type u --regions-file {regions} {source}"
+        )
+    return commands
+
+
 log = snakemake.log_fmt_shell(stdout=False, stderr=True)
 
 extra = snakemake.params.get("extra", "")
+vcf = snakemake.input.get("vcf", snakemake.input[0])
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    shards = contig_shards(vcf, snakemake.threads, tmpdir)
+    if not shards:
+        shell(
+            "vembrane table"  # Tool and its subcommand
+            " {extra}"  # Extra parameters
+            " {snakemake.params.expression:q}"
+            " {vcf}"  # Path to input file
+            " > {snakemake.output}"  # Path to output file
+            " {log}"  # Logging behaviour
+        )
+    else:
+        outputs = [os.path.join(tmpdir, f"shard.{i}.tsv") for i in range(len(shards))]
+        logs = [os.path.join(tmpdir, f"shard.{i}.log") for i in range(len(shards))]
+
+        def table_shard(shard, output, shard_log, header):
+            shell(
+                "{shard}"
+                " | vembrane table"
+                " {extra}"
+                " {header}"
+                " {snakemake.params.expression:q}"
+                " > {output}"
+                " 2> {shard_log}"
+            )
+
+        try:
+            with ThreadPoolExecutor(snakemake.threads) as executor:
+                # Only the first shard writes the table header, so the shard
+                # tables are concatenated as they are
+                headers = [""] + ["--header none"] * (len(shards) - 1)
+                for job in [
+                    executor.submit(table_shard, *args)
+                    for args in zip(shards, outputs, logs, headers)
+                ]:
+                    job.result()
+        finally:
+            if snakemake.log:
+                shell("cat {logs} > {snakemake.log}")
 
-shell(
-    "vembrane table"  # Tool and its subcommand
-    " {extra}"  # Extra parameters
-    " {snakemake.params.expression:q}"
-    " {snakemake.input}"  # Path to input file
-    " > {snakemake.output}"  # Path to output file
-    " {log}"  # Logging behaviour
-)
+        shell("cat {outputs} > {snakemake.output[0]}")
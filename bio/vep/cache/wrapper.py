@@ -3,41 +3,235 @@ __copyright__ = "Copyright 2023, Johannes Köster"
 __email__ = "johannes.koester@uni-due.de"
 __license__ = "MIT"
 
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from snakemake.shell import shell
 
 
+def cached_download(url, dest, cache, max_size=None, log=""):
+    """
+    Download url to dest through a shared download cache
+
+    Entries are keyed by the URL and the validators of its headers (ETag,
+    Last-Modified, Content-Length). Every entry is fetched once under a
+    lock, moved in place when complete and hardlinked to dest (copied,
+    reflinked if possible, across filesystems). Beyond max_size bytes,
+    the least recently used entries are evicted along with their locks.
+    Returns the entry.
+    """
+
+    def lock(path, flags=fcntl.LOCK_EX):
+        # The lock file of an evicted entry may be removed while waiting
+        # for it, in which case the new one is locked instead
+        while True:
+            lock_file = open(path + ".lock", "a")
+            try:
+                fcntl.flock(lock_file, flags)
+            except BlockingIOError:
+                lock_file.close()
+                return None
+            try:
+                if os.path.samestat(
+                    os.fstat(lock_file.fileno()), os.stat(lock_file.name)
+                ):
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+
+    headers = {}
+    try:
+        for line in shell("curl -sSfIL {url} 2> /dev/null", iterable=True):
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+    except subprocess.CalledProcessError:
+        # Servers refusing HEAD requests are keyed by URL only
+        pass
+    validators = [
+        headers.get(h, "") for h in ("etag", "last-modified", "content-length")
+    ]
+    key = hashlib.sha256("\t".join([url, *validators]).encode()).hexdigest()
+
+    os.makedirs(cache, exist_ok=True)
+    entry = os.path.join(cache, key)
+    # Concurrent jobs wait for the first one to populate the entry
+    with lock(entry):
+        if not os.path.exists(entry):
+            partial = entry + ".part"
+            shell("curl -sSfL --continue-at - --output {partial} {url} {log}")
+            os.rename(partial, entry)
+        os.utime(entry)
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(entry, dest)
+        except OSError:
+            shell("cp --reflink=auto {entry} {dest}")
+
+    if max_size:
+        entries = []
+        for candidate in os.scandir(cache):
+            if len(candidate.name) == len(key):
+                try:
+                    stat = candidate.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, candidate.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= max_size:
+                break
+            if path == entry:
+                continue
+            # Entries being populated or linked are kept
+            evicted = lock(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if evicted is None:
+                continue
+            with evicted:
+                if os.path.exists(path):
+                    os.remove(path)
+                os.remove(path + ".lock")
+            total -= size
+    return entry
+
+
 extra = snakemake.params.get("extra", "")
+cache = snakemake.params.get(
+    "cache", os.environ.get("SNAKEMAKE_WRAPPERS_DOWNLOAD_CACHE", "")
+)
+cache_size = snakemake.params.get(
+    "cache_size", os.environ.get("SNAKEMAKE_WRAPPERS_DOWNLOAD_CACHE_SIZE", "")
+)
+max_size = float(cache_size) * 1024**3 if cache_size else None
 
 try:
     release = int(snakemake.params.release)
 except ValueError:
     raise ValueError("The parameter release is supposed to be an integer.")
 
-with tempfile.TemporaryDirectory() as tmpdir:
-    # We download the cache tarball manually because vep_install does not consider proxy settings (in contrast to curl).
-    # See https://github.com/bcbio/bcbio-nextgen/issues/1080
-    vep_dir = "vep" if release >= 97 else "VEP"
-    cache_tarball = (
-        f"{snakemake.params.species}_vep_{release}_{snakemake.params.build}.tar.gz"
-    )
+species = snakemake.params.species
+build = snakemake.params.build
+version = f"{release}_{build}"
+cache_tarball = f"{species}_vep_{release}_{build}.tar.gz"
+tarball_dir = snakemake.params.get("tarball_dir", "")
+# Converted caches are kept next to the downloads unless told otherwise
+converted_cache = snakemake.params.get(
+    "converted_cache", os.path.join(cache, "vep") if cache else ""
+)
+outdir = Path(snakemake.output[0])
+
+
+def copy_tree(src, dest):
+    """Hardlink the files of src to dest, copying them across filesystems"""
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        shell("cp -al {src} {dest} 2> /dev/null")
+    except subprocess.CalledProcessError:
+        shutil.rmtree(dest, ignore_errors=True)
+        shell("cp -r --reflink=auto {src} {dest}")
+
+
+def install(tmpdir):
+    """Unpack the cache tarball to the output and convert it to tabix"""
     log = snakemake.log_fmt_shell(stdout=True, stderr=True)
-    shell(
-        "curl -L ftp://ftp.ensembl.org/pub/release-{snakemake.params.release}/"
-        "variation/{vep_dir}/{cache_tarball} "
-        "-o {tmpdir}/{cache_tarball} {log}"
-    )
+    local = os.path.join(tarball_dir, cache_tarball) if tarball_dir else ""
+    if local and os.path.exists(local):
+        cache_url = tarball_dir
+    else:
+        # We download the cache tarball manually because vep_install does not consider proxy settings (in contrast to curl).
+        # See https://github.com/bcbio/bcbio-nextgen/issues/1080
+        vep_dir = "vep" if release >= 97 else "VEP"
+        url = (
+            f"ftp://ftp.ensembl.org/pub/release-{release}/"
+            f"variation/{vep_dir}/{cache_tarball}"
+        )
+        if cache:
+            cached_download(url, f"{tmpdir}/{cache_tarball}", cache, max_size, log)
+        else:
+            shell("curl -L {url} -o {tmpdir}/{cache_tarball} {log}")
+        cache_url = tmpdir
 
+    # vep_install only unpacks, the conversion is done below
     log = snakemake.log_fmt_shell(stdout=True, stderr=True, append=True)
     shell(
         "vep_install --AUTO c "
-        "--SPECIES {snakemake.params.species} "
-        "--ASSEMBLY {snakemake.params.build} "
+        "--SPECIES {species} "
+        "--ASSEMBLY {build} "
         "--CACHE_VERSION {release} "
-        "--CACHEURL {tmpdir} "
-        "--CACHEDIR {snakemake.output} "
-        "--CONVERT "
+        "--CACHEURL {cache_url} "
+        "--CACHEDIR {outdir} "
         "--NO_UPDATE "
         "{extra} {log}"
     )
+
+    version_dir = outdir / species / version
+    info = version_dir / "info.txt"
+    if "var_type\ttabix" in info.read_text():
+        # Already shipped converted
+        return
+
+    # vep_convert_cache handles the chromosomes one after the other. Each
+    # one is converted on its own in a shadow cache holding a copy of the
+    # info file and a link to the chromosome, which is converted in place.
+    chromosomes = sorted(
+        (path for path in version_dir.iterdir() if path.is_dir()),
+        key=lambda path: sum(f.stat().st_size for f in path.iterdir()),
+        reverse=True,
+    )
+    shadows = [Path(tmpdir) / f"shadow.{i}" for i in range(len(chromosomes))]
+    logs = [Path(tmpdir) / f"shadow.{i}.log" for i in range(len(chromosomes))]
+
+    def convert(chromosome, shadow, shadow_log):
+        shadow_version_dir = shadow / species / version
+        shadow_version_dir.mkdir(parents=True)
+        shutil.copy(info, shadow_version_dir / "info.txt")
+        (shadow_version_dir / chromosome.name).symlink_to(chromosome.resolve())
+        shell(
+            "vep_convert_cache --dir {shadow} --species {species} --version {version}"
+            " > {shadow_log} 2>&1"
+        )
+
+    try:
+        with ThreadPoolExecutor(snakemake.threads) as executor:
+            for job in [
+                executor.submit(convert, *args)
+                for args in zip(chromosomes, shadows, logs)
+            ]:
+                job.result()
+    finally:
+        if snakemake.log:
+            shell("cat {logs} >> {snakemake.log}")
+
+    # All shadows updated their info file the same way (var_type tabix)
+    if shadows:
+        shutil.copy(shadows[0] / species / version / "info.txt", info)
+
+
+if snakemake.log:
+    open(snakemake.log[0], "w").close()
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    if not converted_cache:
+        install(tmpdir)
+    else:
+        converted = Path(converted_cache) / species / version
+        converted.parent.mkdir(parents=True, exist_ok=True)
+        with open(f"{converted}.lock", "w") as lock:
+            # Concurrent jobs wait for the first one to convert the cache
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not converted.exists():
+                install(tmpdir)
+                partial = Path(f"{converted}.part")
+                shutil.rmtree(partial, ignore_errors=True)
+                copy_tree(outdir / species / version, partial)
+                os.rename(partial, converted)
+            else:
+                copy_tree(converted, outdir / species / version)
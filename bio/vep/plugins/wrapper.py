@@ -3,11 +3,107 @@ __copyright__ = "Copyright 2020, Johannes Köster"
 __email__ = "johannes.koester@uni-due.de"
 __license__ = "MIT"
 
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
 import sys
 from pathlib import Path
 from urllib.request import urlretrieve
 from zipfile import ZipFile
 from tempfile import NamedTemporaryFile
+from snakemake.shell import shell
+
+
+def cached_download(url, dest, cache, max_size=None, log=""):
+    """
+    Download url to dest through a shared download cache
+
+    Entries are keyed by the URL and the validators of its headers (ETag,
+    Last-Modified, Content-Length). Every entry is fetched once under a
+    lock, moved in place when complete and hardlinked to dest (copied,
+    reflinked if possible, across filesystems). Beyond max_size bytes,
+    the least recently used entries are evicted along with their locks.
+    Returns the entry.
+    """
+
+    def lock(path, flags=fcntl.LOCK_EX):
+        # The lock file of an evicted entry may be removed while waiting
+        # for it, in which case the new one is locked instead
+        while True:
+            lock_file = open(path + ".lock", "a")
+            try:
+                fcntl.flock(lock_file, flags)
+            except BlockingIOError:
+                lock_file.close()
+                return None
+            try:
+                if os.path.samestat(
+                    os.fstat(lock_file.fileno()), os.stat(lock_file.name)
+                ):
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+
+    headers = {}
+    try:
+        for line in shell("curl -sSfIL {url} 2> /dev/null", iterable=True):
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+    except subprocess.CalledProcessError:
+        # Servers refusing HEAD requests are keyed by URL only
+        pass
+    validators = [
+        headers.get(h, "") for h in ("etag", "last-modified", "content-length")
+    ]
+    key = hashlib.sha256("\t".join([url, *validators]).encode()).hexdigest()
+
+    os.makedirs(cache, exist_ok=True)
+    entry = os.path.join(cache, key)
+    # Concurrent jobs wait for the first one to populate the entry
+    with lock(entry):
+        if not os.path.exists(entry):
+            partial = entry + ".part"
+            shell("curl -sSfL --continue-at - --output {partial} {url} {log}")
+            os.rename(partial, entry)
+        os.utime(entry)
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(entry, dest)
+        except OSError:
+            shell("cp --reflink=auto {entry} {dest}")
+
+    if max_size:
+        entries = []
+        for candidate in os.scandir(cache):
+            if len(candidate.name) == len(key):
+                try:
+                    stat = candidate.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, candidate.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= max_size:
+                break
+            if path == entry:
+                continue
+            # Entries being populated or linked are kept
+            evicted = lock(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if evicted is None:
+                continue
+            with evicted:
+                if os.path.exists(path):
+                    os.remove(path)
+                os.remove(path + ".lock")
+            total -= size
+    return entry
+
 
 if snakemake.log:
     sys.stderr = open(snakemake.log[0], "w")
@@ -15,13 +111,22 @@ if snakemake.log:
 outdir = Path(snakemake.output[0])
 outdir.mkdir()
 
+cache = snakemake.params.get(
+    "cache", os.environ.get("SNAKEMAKE_WRAPPERS_DOWNLOAD_CACHE", "")
+)
+cache_size = snakemake.params.get(
+    "cache_size", os.environ.get("SNAKEMAKE_WRAPPERS_DOWNLOAD_CACHE_SIZE", "")
+)
+max_size = float(cache_size) * 1024**3 if cache_size else None
+
 with NamedTemporaryFile() as tmp:
-    urlretrieve(
-        "https://github.com/Ensembl/VEP_plugins/archive/release/{release}.zip".format(
-            release=snakemake.params.release
-        ),
-        tmp.name,
+    url = "https://github.com/Ensembl/VEP_plugins/archive/release/{release}.zip".format(
+        release=snakemake.params.release
     )
+    if cache:
+        cached_download(url, tmp.name, cache, max_size)
+    else:
+        urlretrieve(url, tmp.name)
 
     with ZipFile(tmp.name) as f:
         for member in f.infolist():
@@ -33,5 +138,6 @@ with NamedTemporaryFile() as tmp:
             if member.is_dir():
                 targetpath.mkdir()
             else:
-                with open(targetpath, "wb") as out:
-                    out.write(f.read(member.filename))
+                # Members are streamed instead of being read into memory
+                with f.open(member) as src, open(targetpath, "wb") as out:
+                    shutil.copyfileobj(src, out, 1 << 20)
@@ -1542,6 +1542,14 @@ def test_vembrane_filter():
     )
 
 
+@skip_if_not_modified
+def test_vembrane_filter_threaded():
+    run(
+        "bio/vembrane/filter",
+        ["snakemake", "--cores", "2", "--use-conda", "filtered/out.threaded.vcf"],
+    )
+
+
 @skip_if_not_modified
 def test_vembrane_table():
     run(
@@ -1550,6 +1558,14 @@ def test_vembrane_table():
     )
 
 
+@skip_if_not_modified
+def test_vembrane_table_threaded():
+    run(
+        "bio/vembrane/table",
+        ["snakemake", "--cores", "2", "--use-conda", "table/out.threaded.tsv"],
+    )
+
+
 @skip_if_not_modified
 def test_shovill():
     run(
@@ -2887,6 +2903,22 @@ def test_deepvariant_gvcf():
     )
 
 
+@skip_if_not_modified
+def test_deepvariant_staged():
+    run(
+        "bio/deepvariant",
+        [
+            "snakemake",
+            "--cores",
+            "2",
+            "staged_calls/a.vcf.gz",
+            "staged_calls/a.g.vcf.gz",
+            "--use-conda",
+            "-F",
+        ],
+    )
+
+
 @skip_if_not_modified
 def test_epic_peaks():
     run(
@@ -2954,6 +2986,21 @@ def test_fastqc():
     )
 
 
+@skip_if_not_modified
+def test_fastqc_subsample():
+    run(
+        "bio/fastqc",
+        [
+            "snakemake",
+            "--cores",
+            "2",
+            "qc/fastqc_subsample/a.html",
+            "--use-conda",
+            "-F",
+        ],
+    )
+
+
 @skip_if_not_modified
 def test_fastq_screen():
     run(
@@ -3483,6 +3530,21 @@ def test_mosdepth_quantize_precision():
     )
 
 
+@skip_if_not_modified
+def test_mosdepth_per_contig():
+    run(
+        "bio/mosdepth",
+        [
+            "snakemake",
+            "--cores",
+            "4",
+            "mosdepth_per_contig/m54075_180905_225130.ccs.ecoliK12_pbi_March2013.mosdepth.summary.txt",
+            "--use-conda",
+            "-F",
+        ],
+    )
+
+
 @skip_if_not_modified
 def test_mosdepth_cram():
     run(
@@ -3514,6 +3576,21 @@ def test_multiqc_a():
     )
 
 
+@skip_if_not_modified
+def test_multiqc_incremental():
+    run(
+        "bio/multiqc",
+        [
+            "snakemake",
+            "--cores",
+            "1",
+            "qc/multiqc.incremental.html",
+            "--use-conda",
+            "-F",
+        ],
+    )
+
+
 @skip_if_not_modified
 def test_muscle_super5():
     run(
@@ -3807,6 +3884,21 @@ def test_pindel_call_exclude():
     )
 
 
+@skip_if_not_modified
+def test_pindel_call_chromosomes():
+    run(
+        "bio/pindel/call",
+        [
+            "snakemake",
+            "--cores",
+            "2",
+            "pindel/all_chroms_D",
+            "--use-conda",
+            "-F",
+        ],
+    )
+
+
 @skip_if_not_modified
 def test_pindel_pindel2vcf():
     run(
@@ -3815,6 +3907,14 @@ def test_pindel_pindel2vcf():
     )
 
 
+@skip_if_not_modified
+def test_pindel_pindel2vcf_chromosomes():
+    run(
+        "bio/pindel/pindel2vcf",
+        ["snakemake", "--cores", "2", "pindel/all_D.chroms.vcf", "--use-conda", "-F"],
+    )
+
+
 @skip_if_not_modified
 def test_pindel_pindel2vcf_multi_input():
     run(
@@ -3978,6 +4078,21 @@ def test_samtools_mpileup():
     )
 
 
+@skip_if_not_modified
+def test_samtools_mpileup_parallel():
+    run(
+        "bio/samtools/mpileup",
+        [
+            "snakemake",
+            "--cores",
+            "4",
+            "mpileup/a.parallel.mpileup.gz",
+            "--use-conda",
+            "-F",
+        ],
+    )
+
+
 @skip_if_not_modified
 def test_samtools_stats():
     run(
@@ -4104,6 +4219,14 @@ def test_bamtools_stats():
     )
 
 
+@skip_if_not_modified
+def test_bam_qc():
+    run(
+        "bio/bam-qc",
+        ["snakemake", "--cores", "4", "qc/a.stats.txt", "--use-conda", "-F"],
+    )
+
+
 @skip_if_not_modified
 def test_snpmutator():
     run(
@@ -4416,6 +4539,14 @@ def test_delly():
     )
 
 
+@skip_if_not_modified
+def test_delly_svtypes():
+    run(
+        "bio/delly",
+        ["snakemake", "--cores", "2", "sv/calls.svtypes.vcf.gz", "--use-conda", "-F"],
+    )
+
+
 @skip_if_not_modified
 def test_manta():
     run(
@@ -5109,6 +5240,14 @@ def test_vardict_paired_mode():
     )
 
 
+@skip_if_not_modified
+def test_vardict_chunked_mode():
+    run(
+        "bio/vardict",
+        ["snakemake", "--cores", "2", "vcf/a.chunked.vcf", "--use-conda", "-F"],
+    )
+
+
 @skip_if_not_modified
 def test_varscan_mpileup2indel():
     run(
@@ -5117,6 +5256,14 @@ def test_varscan_mpileup2indel():
     )
 
 
+@skip_if_not_modified
+def test_varscan_mpileup2indel_parallel():
+    run(
+        "bio/varscan/mpileup2indel",
+        ["snakemake", "--cores", "4", "vcf/a.parallel.vcf", "--use-conda", "-F"],
+    )
+
+
 @skip_if_not_modified
 def test_varscan_mpileup2snp():
     run(
@@ -5125,6 +5272,14 @@ def test_varscan_mpileup2snp():
     )
 
 
+@skip_if_not_modified
+def test_varscan_mpileup2snp_parallel():
+    run(
+        "bio/varscan/mpileup2snp",
+        ["snakemake", "--cores", "4", "vcf/a.parallel.vcf", "--use-conda", "-F"],
+    )
+
+
 @skip_if_not_modified
 def test_varscan_somatic():
     run(
@@ -5133,6 +5288,14 @@ def test_varscan_somatic():
     )
 
 
+@skip_if_not_modified
+def test_varscan_somatic_parallel():
+    run(
+        "bio/varscan/somatic",
+        ["snakemake", "--cores", "4", "vcf/a.parallel.snp.vcf", "--use-conda", "-F"],
+    )
+
+
 @skip_if_not_modified
 def test_umis_bamtag():
     run(
@@ -5374,6 +5537,14 @@ def test_ensembl_sequence_chromosomes():
     )
 
 
+@skip_if_not_modified
+def test_ensembl_sequence_bgzip():
+    run(
+        "bio/reference/ensembl-sequence",
+        ["snakemake", "--cores", "2", "refs/genome.fasta.gz", "--use-conda", "-F"],
+    )
+
+
 @skip_if_not_modified
 def test_ensembl_sequence_chromosome_old_release():
     run(
@@ -5407,6 +5578,36 @@ def test_ensembl_annotation_gtf_gz():
     )
 
 
+@skip_if_not_modified
+def test_ensembl_annotation_cached():
+    run(
+        "bio/reference/ensembl-annotation",
+        [
+            "snakemake",
+            "--cores",
+            "1",
+            "refs/annotation.cached.gtf",
+            "--use-conda",
+            "-F",
+        ],
+    )
+
+
+@skip_if_not_modified
+def test_ensembl_annotation_indexed():
+    run(
+        "bio/reference/ensembl-annotation",
+        [
+            "snakemake",
+            "--cores",
+            "2",
+            "refs/annotation.sorted.gtf.gz",
+            "--use-conda",
+            "-F",
+        ],
+    )
+
+
 @skip_if_not_modified
 def test_ensembl_variation():
     run(
@@ -5440,6 +5641,14 @@ def test_ensembl_variation_chromosome():
     )
 
 
+@skip_if_not_modified
+def test_ensembl_variation_mirror():
+    run(
+        "bio/reference/ensembl-variation",
+        ["snakemake", "-s", "mirror.smk", "--cores", "2", "--use-conda", "-F"],
+    )
+
+
 @skip_if_not_modified
 def test_ensembl_variation_with_contig_lengths():
     run(
@@ -5751,6 +5960,21 @@ def test_fasterq_dump_pe_gz():
     )
 
 
+@skip_if_not_modified
+def test_fasterq_dump_pe_zst():
+    run(
+        "bio/sra-tools/fasterq-dump",
+        [
+            "snakemake",
+            "--cores",
+            "1",
+            "data/pe/SRR14133829_1.fastq.zst",
+            "--use-conda",
+            "-F",
+        ],
+    )
+
+
 @skip_if_not_modified
 def test_fasterq_dump_pe_bz2():
     run(
@@ -5910,6 +6134,14 @@ def test_snpsift_dbnsfp():
     )
 
 
+@skip_if_not_modified
+def test_snpsift_dbnsfp_subset():
+    run(
+        "bio/snpsift/dbnsfp",
+        ["snakemake", "--cores", "1", "out.subset.vcf", "--use-conda", "-F"],
+    )
+
+
 @skip_if_not_modified
 def test_snpsift_annotate():
     run(
@@ -5918,6 +6150,21 @@ def test_snpsift_annotate():
     )
 
 
+@skip_if_not_modified
+def test_snpsift_annotate_subset():
+    run(
+        "bio/snpsift/annotate",
+        [
+            "snakemake",
+            "--cores",
+            "1",
+            "annotated/out.subset.vcf",
+            "--use-conda",
+            "-F",
+        ],
+    )
+
+
 @skip_if_not_modified
 def test_unicycler():
     run(